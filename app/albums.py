@@ -0,0 +1,69 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from pyrogram.types import Message
+
+from config import Bot
+
+
+class AlbumCollector:
+    """Joins the messages of media groups.
+
+    Every message of a media group arrives as a separate update. They are
+    buffered by chat and media_group_id until no message of the group
+    arrives for `delay` seconds, and then the whole group is returned once,
+    to the handler of its first message.
+    """
+
+    def __init__(self, delay: float = 1, size: int = 1000):
+        self.delay = delay
+        self.size = size
+        # Messages and time of the last message, by (chat ID, group ID)
+        self.pending = {}
+        # Groups already returned, to ignore their late messages
+        self.done = OrderedDict()
+
+    async def collect(self, message: Message) -> list | None:
+        """Add a message of a media group.
+
+        Returns the messages of the group, sorted by ID, to the first
+        message, and None to the others.
+        """
+        key = (message.chat.id, message.media_group_id)
+        if key in self.done:
+            return None
+        if key in self.pending:
+            entry = self.pending[key]
+            entry["messages"][message.id] = message
+            entry["updated"] = time.monotonic()
+            return None
+
+        entry = {"messages": {message.id: message},
+                 "updated": time.monotonic()}
+        self.pending[key] = entry
+        try:
+            while True:
+                wait = entry["updated"] + self.delay - time.monotonic()
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+        finally:
+            del self.pending[key]
+
+        self.done[key] = True
+        if len(self.done) > self.size:
+            self.done.popitem(last=False)
+        return [entry["messages"][id] for id in sorted(entry["messages"])]
+
+
+collector = None
+
+
+def get_collector() -> AlbumCollector:
+    """Get the album collector configured in the bot.json file."""
+    global collector
+    if collector is None:
+        config = Bot().get_config().get("media_groups", {})
+        collector = AlbumCollector(**config)
+    return collector
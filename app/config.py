@@ -1,8 +1,13 @@
+import asyncio
+import atexit
 import json
 import os
+import time
 from pathlib import Path
+from types import MappingProxyType
 
 from logger import logger
+from storage import MessageStore, JSONMessageStore, SQLiteMessageStore
 
 # Create a folder that will hold the configuration files
 app_dir = Path(__file__).parent
@@ -10,16 +15,109 @@ config_dir = app_dir / "config"
 config_dir.mkdir(exist_ok=True)
 
 
+def file_stamp(path: Path) -> tuple | None:
+    """Return the (mtime, size) pair used to detect changes in a file."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def freeze(value):
+    """Return a read-only copy of a parsed JSON value."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Return a mutable copy of a frozen JSON value."""
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
 class Bot:
     bot = {
         "api_id": 1234567,
         "api_hash": "0123456789abcdef0123456789abcdef",
-        "admins": []
+        "admins": [],
+        "message_store": "sqlite",
+        "message_flush_size": 200,
+        "message_flush_interval": 0.25,
+        "last_texts_file": "last_texts.db",
+        "message_retention": {
+            "max_age_days": 0,
+            "max_entries": 0,
+            "max_total": 0,
+            "targets": {}
+        },
+        "translation": {
+            "backend": "google",
+            "concurrency": 4,
+            "timeout": 10,
+            "cache_size": 1000,
+            "cache_file": "translations.db",
+            "cache_disk_size": 100000
+        },
+        "image_checks": {
+            "workers": 2,
+            "timeout": 30,
+            "max_pending": 16,
+            "on_failure": "allow",
+            "cache_size": 32
+        },
+        "media": {
+            "memory_limit": 10485760,
+            "spool_dir": None,
+            "spool_max_bytes": 2147483648,
+            "spool_wait_timeout": 300
+        },
+        "dispatch": {
+            "workers": 16,
+            "bulk_workers": 4,
+            "backlog": 100
+        },
+        "rate_limits": {
+            "account": {"rate": 20, "burst": 30},
+            "private": {"rate": 1, "burst": 3},
+            "group": {"rate": 0.33, "burst": 5},
+            "channel": {"rate": 0.33, "burst": 5},
+            "targets": {},
+            "max_retries": 5
+        },
+        "outbox": {
+            "max_attempts": 8,
+            "retry_delay": 5,
+            "max_retry_delay": 900
+        },
+        "media_groups": {
+            "delay": 1
+        }
     }
 
-    def get_config(self) -> dict:
+    # The parsed bot.json is shared by every instance, so the file is only
+    # parsed again when it changes on disk or an admin is added
+    _snapshot = None
+    _stamp = None
+    _admins = frozenset()
+    # Seconds between checks for changes in bot.json
+    check_interval = 1
+    _checked = 0
+
+    def get_config(self) -> MappingProxyType:
         """Load the bot configuration from the bot.json file."""
-        if not os.path.exists(config_dir/"bot.json"):
+        path = config_dir/"bot.json"
+        if Bot._snapshot is not None and\
+                time.monotonic() - Bot._checked < Bot.check_interval:
+            return Bot._snapshot
+
+        if not os.path.exists(path):
             logger.error("bot.json not found")
             logger.warning("bot.json has been created with default values. " +
                            "Please edit it with your own api_id and api_hash" +
@@ -28,7 +126,7 @@ class Bot:
                            "you can also use the API_ID and API_HASH " +
                            "envinroment variables.")
 
-            with open(config_dir/"bot.json", "w") as f:
+            with open(path, "w") as f:
                 json.dump(self.bot, f, indent=4, ensure_ascii=False)
 
             if not os.getenv("API_ID") or not os.getenv("API_HASH"):
@@ -38,44 +136,122 @@ class Bot:
                 logger.error("Exiting...")
                 exit(1)
 
-        with open(config_dir/"bot.json", "r") as f:
-            return json.load(f)
+        stamp = file_stamp(path)
+        if Bot._snapshot is None or stamp != Bot._stamp:
+            with open(path, "r") as f:
+                Bot._snapshot = freeze(json.load(f))
+            Bot._stamp = stamp
+            Bot._admins = frozenset(Bot._snapshot["admins"])
+        Bot._checked = time.monotonic()
+
+        return Bot._snapshot
+
+    def get_admins(self) -> frozenset:
+        """Get the IDs of the admins."""
+        self.get_config()
+        return Bot._admins
 
     def add_admin(self, admin: int) -> None:
         """Add an admin to the bot configuration."""
-        if admin not in self.get_config()["admins"]:
-            config = self.get_config()
+        if admin not in self.get_admins():
+            config = thaw(self.get_config())
             config["admins"].append(admin)
 
             with open(config_dir/"bot.json", "w") as f:
                 json.dump(config, f, indent=4, ensure_ascii=False)
+            Bot._snapshot = None
 
 
-class Forwarding:
-    forwarding = {"forwarders": [], "blocked_images": []}
+def build_routes(config: MappingProxyType) -> MappingProxyType:
+    """Build the source chat ID -> forwarders index of a configuration."""
+    routes = {}
 
-    async def get_config(self) -> dict:
-        """Load the forwarding configuration from the forwarding.json file."""
-        if not os.path.exists(config_dir/"forwarding.json"):
+    for forwarder in config["forwarders"]:
+        if not forwarder["enabled"]:
+            continue
+
+        for source in forwarder["source"].keys():
+            route = routes.setdefault(int(source), {
+                "incoming": [], "outgoing": [],
+                "muted_incoming": [], "muted_outgoing": []})
+
+            for direction in ("incoming", "outgoing"):
+                if forwarder[direction]:
+                    route[direction].append(forwarder)
+                else:
+                    route[f"muted_{direction}"].append(forwarder)
+
+    return MappingProxyType({
+        source: MappingProxyType({k: tuple(v) for k, v in route.items()})
+        for source, route in routes.items()})
+
+
+class Forwarding:
+    forwarding = {"forwarders": [], "blocked_images": [],
+                  "blocked_image_hashes": {}}
+
+    # The parsed forwarding.json is shared by every instance, so the file is
+    # only parsed again when it changes on disk or a writer invalidates it.
+    _snapshot = None
+    _stamp = None
+    # Values computed from the current snapshot (indexes, compiled rules...)
+    _derived = {}
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Drop the cached forwarding configuration."""
+        cls._snapshot = None
+        cls._stamp = None
+        cls._derived = {}
+
+    async def get_config(self) -> MappingProxyType:
+        """Load the forwarding configuration from the forwarding.json file.
+
+        The returned snapshot is read-only and shared by every reader, use
+        `get_forwarder` or `thaw` to get a copy that can be modified.
+        """
+        path = config_dir/"forwarding.json"
+        if not os.path.exists(path):
             logger.warning("forwarding.json not found")
 
-            with open(config_dir/"forwarding.json", "w") as f:
+            with open(path, "w") as f:
                 json.dump(self.forwarding, f, indent=4, ensure_ascii=False)
 
-        with open(config_dir/"forwarding.json", "r") as f:
-            return json.load(f)
+        stamp = file_stamp(path)
+        if Forwarding._snapshot is None or stamp != Forwarding._stamp:
+            logger.debug("Loading forwarding.json")
+            with open(path, "r") as f:
+                Forwarding._snapshot = freeze(json.load(f))
+            Forwarding._stamp = stamp
+            Forwarding._derived = {}
 
-    async def get_forwarding_ids(self) -> list:
-        """Get the list of forwarding IDs."""
-        forwarders = (await self.get_config())["forwarders"]
-        forwarding_ids = []
+        return Forwarding._snapshot
 
-        for forwarder in forwarders:
-            for id in forwarder["source"].keys():
-                forwarding_ids.append(int(id))
+    async def save_config(self, config: dict) -> None:
+        """Write the forwarding configuration and invalidate the cache."""
+        with open(config_dir/"forwarding.json", "w") as f:
+            json.dump(config, f, indent=4, ensure_ascii=False)
+        self.invalidate()
 
-        # Remove duplicates and return the list
-        return list(dict.fromkeys(forwarding_ids))
+    async def get_derived(self, key, build):
+        """Get a value built from the current configuration snapshot.
+
+        `build` is called with the snapshot the first time `key` is requested
+        and again only after the configuration changes.
+        """
+        config = await self.get_config()
+        if key not in Forwarding._derived:
+            Forwarding._derived[key] = build(config)
+        return Forwarding._derived[key]
+
+    async def get_routes(self) -> MappingProxyType:
+        """Get the routing index of the enabled forwarders.
+
+        Maps every source chat ID to the forwarders that copy its incoming
+        and outgoing messages. The "muted_incoming" and "muted_outgoing"
+        entries hold the forwarders that have that direction disabled.
+        """
+        return await self.get_derived("routes", build_routes)
 
     async def get_forwardings(self) -> list:
         """Get the list of forwarding targets"""
@@ -94,11 +270,11 @@ class Forwarding:
 
         for forwarder in forwarders:
             if str(forwarder["target"]) == forwarder_id:
-                return forwarder
+                return thaw(forwarder)
 
     async def update_forwarder(self, forwarder_dict: dict):
         """Update the forwarding configuration."""
-        config = await self.get_config()
+        config = thaw(await self.get_config())
         target = forwarder_dict["target"]
 
         for forwarder in config["forwarders"]:
@@ -106,12 +282,11 @@ class Forwarding:
                 for key, value in forwarder_dict.items():
                     forwarder[key] = value
 
-        with open(config_dir/"forwarding.json", "w") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        await self.save_config(config)
 
     async def add_forwarder(self, name: str, target: str, source: dict):
         """Add a new forwarding rule."""
-        config = await self.get_config()
+        config = thaw(await self.get_config())
         config["forwarders"].append(
             {
                 "name": name,
@@ -122,6 +297,8 @@ class Forwarding:
                 "outgoing": True,
                 "reply": True,
                 "duplicated_text": False,
+                "dedupe": False,
+                "dedupe_window": 600,
                 "send_text_only": False,
                 "translate": False,
                 "translate_to": "en",
@@ -137,59 +314,166 @@ class Forwarding:
             }
         )
 
-        with open(config_dir/"forwarding.json", "w") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        await self.save_config(config)
 
     async def remove_forwarder(self, forwarder_id: str):
         """Remove a forwarding rule."""
-        config = await self.get_config()
+        config = thaw(await self.get_config())
 
-        for forwarder in config["forwarders"]:
-            if forwarder["target"] == int(forwarder_id):
-                config["forwarders"].remove(forwarder)
+        config["forwarders"] = [
+            forwarder for forwarder in config["forwarders"]
+            if forwarder["target"] != int(forwarder_id)]
 
-        with open(config_dir/"forwarding.json", "w") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        await self.save_config(config)
 
     async def get_blocked_images(self) -> list:
         """Get the list of blocked images."""
         config = await self.get_config()
-        blocked_images = config["blocked_images"]
+        blocked_images = list(config["blocked_images"])
 
         return blocked_images
 
-    async def add_blocked_image(self, image: str):
-        """Add a new blocked image."""
-        config = await self.get_config()
+    async def add_blocked_image(self, image: str, info: dict | None = None):
+        """Add a new blocked image.
+
+        `info` holds the hash, height and width of the image, used to find
+        similar images without opening every blocked image.
+        """
+        config = thaw(await self.get_config())
         config["blocked_images"].append(image)
+        if info is not None:
+            config.setdefault("blocked_image_hashes", {})[image] = info
 
-        with open(config_dir/"forwarding.json", "w") as f:
-            json.dump(config, f, indent=4, ensure_ascii=False)
+        await self.save_config(config)
 
 
 class MessagesIDs:
-    async def get_message_ids(self) -> list:
-        """Get the list of message IDs."""
-        if not os.path.exists(config_dir/"messages.json"):
-            logger.warning("messages.json not found")
-
-            with open(config_dir/"messages.json", "w") as f:
-                json.dump({}, f, indent=4, ensure_ascii=False)
-
-        with open(config_dir/"messages.json", "r") as f:
-            return json.load(f)
+    # Message ID map backend, shared by every instance
+    _store = None
+    # New message IDs not yet written to the backend (write-behind buffer)
+    _pending = {}
+    _flush_handle = None
+    # Recently used message IDs, to evict the least recently used ones
+    _touched = set()
+    _prune_task = None
+    stats = {"lookups": 0, "misses": 0, "evicted_misses": 0, "evicted": 0}
+
+    def get_store(self) -> MessageStore:
+        """Get the message ID map backend selected in bot.json."""
+        if MessagesIDs._store is not None:
+            return MessagesIDs._store
+
+        config = Bot().get_config()
+        backend = config.get("message_store", "sqlite")
+        if backend == "json":
+            store = JSONMessageStore(config_dir/"messages.json")
+        else:
+            if backend != "sqlite":
+                logger.error(f"Unknown message store '{backend}', " +
+                             "using sqlite")
+            store = SQLiteMessageStore(config_dir/"messages.db")
+            # Migrate the message IDs of the old JSON map
+            if os.path.exists(config_dir/"messages.json"):
+                store.import_json(config_dir/"messages.json")
+
+        MessagesIDs._store = store
+        MessagesIDs.flush_size = config.get("message_flush_size", 200)
+        MessagesIDs.flush_interval = config.get("message_flush_interval",
+                                                0.25)
+        MessagesIDs.retention = config.get("message_retention", {})
+        # Don't lose the buffered message IDs when the process exits
+        atexit.register(self.flush)
+        return store
+
+    def flush(self) -> None:
+        """Write the buffered message IDs to the backend."""
+        if MessagesIDs._flush_handle is not None:
+            MessagesIDs._flush_handle.cancel()
+            MessagesIDs._flush_handle = None
+        if MessagesIDs._touched:
+            self.get_store().touch_many(list(MessagesIDs._touched))
+            MessagesIDs._touched = set()
+        if not MessagesIDs._pending:
+            return
+
+        rows = [(*key, copy_id)
+                for key, copy_id in MessagesIDs._pending.items()]
+        MessagesIDs._pending = {}
+        logger.debug(f"Writing {len(rows)} message IDs")
+        self.get_store().add_many(rows)
+
+    async def prune(self, interval: float = 60, batch: int = 1000) -> None:
+        """Delete the message IDs out of the retention policy, in batches.
+
+        Runs forever in the background, a batch of at most `batch` IDs is
+        deleted every `interval` seconds, or right away while there are
+        more to delete.
+        """
+        while True:
+            self.flush()
+            deleted = self.get_store().prune(MessagesIDs.retention, batch)
+            if deleted:
+                MessagesIDs.stats["evicted"] += deleted
+                logger.debug(f"Evicted {deleted} message IDs")
+            await asyncio.sleep(1 if deleted >= batch else interval)
+
+    async def get_message_id(self, target: str, source: str,
+                             real_id: int) -> int | None:
+        """Get the ID of the copy of a message in the target chat."""
+        key = (int(target), int(source), int(real_id))
+        MessagesIDs.stats["lookups"] += 1
+        if key in MessagesIDs._pending:
+            return MessagesIDs._pending[key]
+
+        store = self.get_store()
+        copy_id = store.get(*key)
+        if copy_id is None:
+            MessagesIDs.stats["misses"] += 1
+            if store.was_evicted(*key):
+                MessagesIDs.stats["evicted_misses"] += 1
+                logger.debug(f"Message ID {real_id} of {source} in {target} "
+                             "was evicted")
+        elif MessagesIDs.retention.get("max_total"):
+            MessagesIDs._touched.add(key)
+        return copy_id
+
+    async def find_message_ids(self, real_id: int,
+                               source: str | None = None) -> list:
+        """Get the (target, source, copy_id) rows of the copies of a message.
+
+        If `source` is None, the message is looked up in every source chat.
+        """
+        if source is not None:
+            source = int(source)
+        rows = {(target, chat): copy_id for target, chat, copy_id in
+                self.get_store().find(int(real_id), source)}
+
+        for (target, chat, id), copy_id in MessagesIDs._pending.items():
+            if id == int(real_id) and source in (None, chat):
+                rows[(target, chat)] = copy_id
+
+        return [(*key, copy_id) for key, copy_id in rows.items()]
 
     async def add_message_id(self, target: str, source: str, real_id: int,
                              copy_id: int):
-        """Add a message ID to the list of IDs."""
-        logger.debug(f"Adding message ID {copy_id} to {source} in {target}")
-        messages_ids = await self.get_message_ids()
+        """Add a message ID to the list of IDs.
 
-        if target not in messages_ids:
-            messages_ids[target] = {}
-        if source not in messages_ids[target]:
-            messages_ids[target][source] = {}
-        messages_ids[target][source][str(real_id)] = copy_id
-
-        with open(config_dir/"messages.json", "w") as f:
-            json.dump(messages_ids, f, indent=4, ensure_ascii=False)
+        The ID is available right away, but it is written to the backend in
+        batches, once `message_flush_size` IDs are buffered or
+        `message_flush_interval` seconds after the first one.
+        """
+        logger.debug(f"Adding message ID {copy_id} to {source} in {target}")
+        self.get_store()
+        if MessagesIDs._prune_task is None and any(
+                [MessagesIDs.retention.get(rule) for rule in
+                 ("max_age_days", "max_entries", "max_total", "targets")]):
+            MessagesIDs._prune_task = asyncio.create_task(self.prune())
+        key = (int(target), int(source), int(real_id))
+        MessagesIDs._pending[key] = copy_id
+
+        if len(MessagesIDs._pending) >= MessagesIDs.flush_size:
+            self.flush()
+        elif MessagesIDs._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            MessagesIDs._flush_handle = loop.call_later(
+                MessagesIDs.flush_interval, self.flush)
@@ -0,0 +1,56 @@
+import hashlib
+import time
+import unicodedata
+from collections import OrderedDict
+
+from pyrogram.types import Message
+
+
+def fingerprint(message: Message) -> int | None:
+    """Get the fingerprint of the content of a message.
+
+    It's the file_unique_id of its media, the same for every copy of a
+    file, or the hash of its text, ignoring case and spaces. Messages
+    without either have no fingerprint.
+    """
+    media = getattr(message, message.media.value, None)\
+        if message.media else None
+    unique_id = getattr(media, "file_unique_id", None)
+    if unique_id:
+        key = f"file:{unique_id}"
+    else:
+        text = message.text or message.caption
+        if not text:
+            return None
+        text = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+        key = f"text:{text}"
+
+    # 8 bytes per fingerprint, whatever the length of the text
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class RecentSet:
+    """Fingerprints seen in the last seconds, at most `size` of them."""
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        # Time each fingerprint was first seen, oldest first
+        self.entries = OrderedDict()
+
+    def add(self, key: int, window: float) -> bool:
+        """Add a fingerprint, and check if it was already added in the last
+        `window` seconds."""
+        now = time.monotonic()
+        while self.entries:
+            oldest, added = next(iter(self.entries.items()))
+            if now - added <= window:
+                break
+            del self.entries[oldest]
+
+        if key in self.entries:
+            return True
+        self.entries[key] = now
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return False
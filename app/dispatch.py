@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections import Counter, deque
+
+from config import Bot
+from logger import logger
+
+LANES = ("fast", "bulk")
+
+
+class Scheduler:
+    """Sends the messages to their targets on a pool of workers.
+
+    Every target has two queues, or lanes: "fast" for texts, edits and
+    deletions, and "bulk" for media that has to be uploaded. The jobs of a
+    lane of a target run one after another, in the order they were
+    submitted, so the texts sent to a target don't wait for a big upload to
+    the same target. A fast job that refers to a message still waiting in
+    the bulk lane goes to the bulk lane, after it.
+
+    `workers` jobs run at the same time, at most `bulk_workers` of them from
+    bulk lanes, and the workers take the fast jobs first. At most `backlog`
+    jobs can wait for the same target, the next ones wait to be submitted.
+    """
+
+    def __init__(self, workers: int = 16, bulk_workers: int = 4,
+                 backlog: int = 100):
+        self.workers = workers
+        self.bulk_workers = bulk_workers
+        self.backlog = backlog
+        # Jobs by (target, lane), and the lanes with jobs that can run
+        self.queues = {}
+        self.ready = {lane: deque() for lane in LANES}
+        self.running = set()
+        self.running_bulk = 0
+        # Backlog semaphores and referenced messages of bulk jobs, by target
+        self.backlogs = {}
+        self.bulk_refs = {}
+        self.changed = None
+        self.tasks = []
+        self.stats = {lane: {"jobs": 0, "wait": 0.0, "max_wait": 0.0}
+                      for lane in LANES}
+
+    def depth(self, lane: str) -> int:
+        """Get the number of jobs waiting in a lane of every target."""
+        return sum(len(jobs) for (_, job_lane), jobs in self.queues.items()
+                   if job_lane == lane)
+
+    async def submit(self, target: int, lane: str, refs: set, function,
+                     *args, **kwargs) -> asyncio.Future:
+        """Queue `function(*args, **kwargs)` in a lane of the target.
+
+        `refs` are the keys of the messages the job refers to. The returned
+        future is done when the job has run.
+        """
+        if not self.tasks:
+            self.changed = asyncio.Condition()
+            self.tasks = [asyncio.create_task(self._work())
+                          for _ in range(self.workers)]
+
+        backlog = self.backlogs.setdefault(target,
+                                           asyncio.Semaphore(self.backlog))
+        await backlog.acquire()
+
+        pending = self.bulk_refs.setdefault(target, Counter())
+        if lane == "fast" and any(pending[ref] for ref in refs):
+            lane = "bulk"
+        if lane == "bulk":
+            pending.update(refs)
+
+        future = asyncio.get_running_loop().create_future()
+        key = (target, lane)
+        jobs = self.queues.setdefault(key, deque())
+        jobs.append((future, time.monotonic(), refs, function, args, kwargs))
+        async with self.changed:
+            if len(jobs) == 1 and key not in self.running:
+                self.ready[lane].append(key)
+                self.changed.notify()
+        return future
+
+    def _can_run(self) -> bool:
+        return bool(self.ready["fast"]) or (
+            bool(self.ready["bulk"]) and
+            self.running_bulk < self.bulk_workers)
+
+    async def _work(self) -> None:
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(self._can_run)
+                lane = "fast" if self.ready["fast"] else "bulk"
+                key = self.ready[lane].popleft()
+                self.running.add(key)
+                if lane == "bulk":
+                    self.running_bulk += 1
+
+            target = key[0]
+            future, submitted, refs, function, args, kwargs =\
+                self.queues[key].popleft()
+            wait = time.monotonic() - submitted
+            stats = self.stats[lane]
+            stats["jobs"] += 1
+            stats["wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+
+            try:
+                await function(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"The message could not be sent to {target}: "
+                             f"{type(e).__name__}: {e}")
+            finally:
+                if lane == "bulk":
+                    pending = self.bulk_refs[target]
+                    pending.subtract(refs)
+                    for ref in refs:
+                        if pending[ref] <= 0:
+                            del pending[ref]
+                    self.running_bulk -= 1
+                self.backlogs[target].release()
+                if not future.done():
+                    future.set_result(None)
+
+                async with self.changed:
+                    self.running.discard(key)
+                    if self.queues[key]:
+                        self.ready[lane].append(key)
+                    else:
+                        del self.queues[key]
+                    self.changed.notify_all()
+
+
+scheduler = None
+
+
+def get_scheduler() -> Scheduler:
+    """Get the scheduler configured in the bot.json file."""
+    global scheduler
+    if scheduler is None:
+        config = Bot().get_config().get("dispatch", {})
+        scheduler = Scheduler(config.get("workers", 16),
+                              config.get("bulk_workers", 4),
+                              config.get("backlog", 100))
+    return scheduler
@@ -10,16 +10,14 @@
 # TODO: Toggle message removal from the chat.
 # TODO: Edited, deleted, pinned, replied messages toggles.
 
-import os
 import re
-import datetime
+import json
+import asyncio
+import hashlib
+from io import BytesIO
 from pathlib import Path
 from os import getenv
 
-from deep_translator import GoogleTranslator
-from sewar.full_ref import uqi
-from cv2 import imread
-
 from pyrogram import Client, filters
 from pyrogram.raw.functions.messages import SendVote
 from pyrogram.enums import MessageMediaType, PollType
@@ -30,8 +28,20 @@ from pyrogram.errors.exceptions.bad_request_400 import (MediaInvalid,
                                                         MessageIdInvalid,
                                                         MessageNotModified)
 
-from config import Bot, Forwarding, MessagesIDs
+from albums import get_collector
+from config import Bot, Forwarding, MessagesIDs, thaw
+from dedupe import RecentSet, fingerprint
+from dispatch import get_scheduler
+from images import (BlockedImages, THUMB_DISTANCE, decode, dhash,
+                    get_checker)
 from logger import logger
+from matcher import BlockedWords
+from outbox import TRANSIENT_ERRORS, get_outbox
+from ratelimit import get_limiter
+from rewrite import Rewriter
+from storage import LastTexts
+from media import get_spool
+from translation import get_translator
 
 # Config path
 app_dir = Path(__file__).parent
@@ -46,22 +56,56 @@ API_ID = getenv("API_ID") if getenv("API_ID") else bot_config["api_id"]
 API_HASH = getenv("API_HASH") if getenv("API_HASH") else bot_config["api_hash"]
 
 user = Client(str(Path(config_dir/"user")), API_ID, API_HASH)
-current_media_group = None  # Current media group ID
 
 Messages = MessagesIDs()
 Forwardings = Forwarding()
-
-
-async def is_identical_to_last(message: Message, target: int) -> bool:
-    """Check if the message is identical to the last message"""
-    generator = message._client.get_chat_history(target, 1)
-    last_message = [m async for m in generator]
-    return message.text == last_message[0].text
+# Also removes the files downloaded by the last run
+spool = get_spool()
+scheduler = get_scheduler()
+# Calls that send to a chat go through the rate limiter
+sender = get_limiter(user)
+# Deliveries are written to the outbox before they are sent
+outbox = get_outbox()
+# Joins the messages of media groups
+albums = get_collector()
+# Tasks running in the background, see spawn
+background = set()
+# Contents sent recently by each forwarder, see is_duplicate
+recent_contents = {}
+# Text of the last message sent to each target, see is_identical_to_last
+last_texts_file = bot_config.get("last_texts_file", "last_texts.db")
+last_texts = LastTexts(config_dir/last_texts_file if last_texts_file else None)
+
+# Forwarder settings that change the text of the messages
+TEXT_SETTINGS = ("replace_words_mode", "replace_words", "patterns",
+                 "translate", "translate_to", "translate_from",
+                 "translate_show_original", "translate_original_prefix",
+                 "translate_translation_prefix")
+# Media that is downloaded and uploaded again from protected chats
+DOWNLOADABLE_MEDIA = (MessageMediaType.PHOTO, MessageMediaType.VIDEO,
+                      MessageMediaType.AUDIO, MessageMediaType.VOICE,
+                      MessageMediaType.DOCUMENT, MessageMediaType.ANIMATION,
+                      MessageMediaType.VIDEO_NOTE, MessageMediaType.STICKER)
+
+
+async def is_identical_to_last(text: str, target: int) -> bool:
+    """Check if the text is identical to the last message sent to the target
+
+    The last message is only fetched if the target has no fingerprint yet.
+    """
+    if last_texts.get(target) is None:
+        async for last_message in user.get_chat_history(target, 1):
+            last_texts.set(target, last_message.text)
+            break
+        else:
+            last_texts.set(target, None)
+    return last_texts.fingerprint(text) == last_texts.get(target)
 
 
 async def translate(text: str, to: str, from_: str, show_original: bool,
-                    original_prefix: str, translation_prefix: str) -> str:
-    """Translate the text"""
+                    original_prefix: str,
+                    translation_prefix: str) -> str | None:
+    """Translate the text, or return None if the translation failed"""
     strip_text = False
     found_hashtag = re.search(r"#\w+\b", text)
 
@@ -71,8 +115,10 @@ async def translate(text: str, to: str, from_: str, show_original: bool,
         text = text.replace(stripped_text, "3141592")
         strip_text = True
 
-    # Translate the text
-    translated_text = GoogleTranslator(from_, to).translate(text)
+    # Translate the text, off the event loop
+    translated_text = await get_translator().translate(text, from_, to)
+    if translated_text is None:
+        return None
     if strip_text:
         translated_text = translated_text.replace("3141592", stripped_text)
         text = text.replace("3141592", stripped_text)
@@ -105,79 +151,176 @@ async def get_media_type(message: Message) -> str:
             return message.sticker.file_id
 
 
-async def is_image_blocked(message: Message) -> bool:
-    """Check if the image is blocked"""
-    imgs = await Forwardings.get_blocked_images()
+async def save_upload(message: Message, sent: Message) -> None:
+    """Save the file ID of media uploaded from a chat with protected content,
+    for the next targets"""
+    if message.chat.has_protected_content and sent.media is not None:
+        file_id = await get_media_type(sent)
+        if file_id is not None:
+            spool.uploaded(message, file_id)
+
+
+async def is_image_blocked(message: Message,
+                           checks: dict | None = None) -> bool:
+    """Check if the image is blocked
+
+    `checks` are the checks of the images of the message already done for
+    its other targets, by file_unique_id. The image is only checked once
+    for every target, and the thumbnail and the photo downloaded once.
+    """
+    if checks is None:
+        return await check_image(message)
+
+    key = message.photo.file_unique_id
+    if key in checks:
+        logger.debug("Image already checked for another target")
+        return await checks[key]
+
+    # Other targets wait for this result instead of checking the image
+    future = asyncio.get_running_loop().create_future()
+    checks[key] = future
+
+    try:
+        blocked = await check_image(message)
+    except BaseException as e:
+        checks.pop(key, None)
+        if isinstance(e, Exception):
+            future.set_exception(e)
+            future.exception()  # Don't warn if nobody else was waiting
+        else:
+            future.cancel()
+        raise
+    future.set_result(blocked)
+    return blocked
+
+
+async def check_image(message: Message) -> bool:
+    """Compare the image with the blocked images"""
+    blocked_images = await Forwardings.get_derived("blocked_images",
+                                                   BlockedImages)
+    height, width = message.photo.height, message.photo.width
+
+    # The exact same photo was blocked
+    if message.photo.file_unique_id in blocked_images.unique_ids:
+        logger.debug("Image is blocked by its file_unique_id")
+        return True
+
+    # Only images of the same size can be blocked
+    if (height, width) not in blocked_images.sizes:
+        return False
+
+    # If the smallest thumbnail doesn't look like any blocked image, the
+    # full photo doesn't need to be downloaded
+    candidates = blocked_images.sizes[(height, width)]
+    if message.photo.thumbs:
+        thumb = min(message.photo.thumbs, key=lambda t: t.width * t.height)
+        data = await message._client.download_media(thumb.file_id,
+                                                     in_memory=True)
+        thumb_img = decode(bytes(data.getbuffer()))
+        if thumb_img is not None:
+            candidates = blocked_images.candidates(
+                dhash(thumb_img), height, width, THUMB_DISTANCE)
+        if not candidates:
+            logger.debug("Image thumbnail is not similar to blocked images")
+            return False
+
+    # Download the photo, shared with the copies, and compare it on a worker
+    # process
+    image = await spool.acquire(message)
+    checker = get_checker()
+    try:
+        data = image.getvalue() if isinstance(image, BytesIO) else image
+        return await checker.find_blocked(data, candidates)
+    finally:
+        spool.release(message)
+
 
-    # Set name of the image to current timestamp
-    name = datetime.datetime.now().timestamp()
+async def is_forwarder(filter, client: Client, message: Message) -> bool:
+    """Check if the chat id is in the forwarding list"""
+    id = message.chat.id
+    routes = await Forwardings.get_routes()
+    return id in routes
 
-    # Download the photo and read it with cv2
-    test_path = await message.download(config_dir/"blocked_img"/f"{name}.jpg")
-    test_img = imread(test_path)
 
-    # Remove the downloaded photo (this is safe because is already in memory)
-    if os.path.isfile(test_path):
-        os.remove(test_path)
+async def get_fingerprint(forwarder: dict) -> str:
+    """Get the hash of the settings of the forwarder that change the text"""
+    fingerprints = await Forwardings.get_derived("fingerprints", lambda _: {})
+    target = forwarder["target"]
 
-    for img in imgs:
-        # Open original image
-        og_img = imread(img)
+    if target not in fingerprints:
+        # The order of the replace words matters, so the keys aren't sorted
+        settings = [thaw(forwarder[key]) for key in TEXT_SETTINGS]
+        fingerprints[target] = hashlib.sha1(
+            json.dumps(settings, ensure_ascii=False).encode()).hexdigest()
+    return fingerprints[target]
 
-        # Check if the image is the same size
-        if og_img.shape[:2] == (message.photo.height, message.photo.width):
-            # Check similarity with the original image
-            if uqi(test_img, og_img) >= 0.9:
-                logger.debug(f"Image '{img}' is blocked")
-                return True
 
-    return False
+async def get_rewriter(forwarder: dict) -> Rewriter:
+    """Get the compiled text rewriting rules of the forwarder"""
+    rewriters = await Forwardings.get_derived("rewriters", lambda _: {})
+    fingerprint = await get_fingerprint(forwarder)
 
+    # Compiled once per configuration version, and shared by the
+    # forwarders with the same rules
+    if fingerprint not in rewriters:
+        rewriters[fingerprint] = Rewriter(forwarder)
+    return rewriters[fingerprint]
 
-async def is_forwarder(filter, client: Client, message: Message) -> bool:
-    """Check if the chat id is in the forwarding list"""
-    id = message.chat.id
-    forwarding_ids = await Forwardings.get_forwarding_ids()
-    return id in forwarding_ids
 
+async def replace_words(target: dict, text: str, is_caption: bool = False,
+                        texts: dict | None = None) -> str:
+    """Replace words and select text with regex
 
-async def replace_words(target: dict, text: str,
-                        is_caption: bool = False) -> str:
-    """Replace words and select text with regex"""
-    words = target["replace_words"]
+    `texts` are the texts of the message already processed for its other
+    targets, keyed by (fingerprint, is_caption, text). The forwarders with
+    the same text settings share the result, so a message sent to several
+    targets is only processed (and translated) once per distinct set of
+    rules.
+    """
     if text is None:
         logger.debug("Text is None, returning an empty string")
         return ""
+    if texts is None:
+        text, _ = await process_text(target, text, is_caption)
+        return text
+
+    key = (await get_fingerprint(target), is_caption, text)
+    if key in texts:
+        logger.debug("Text already processed for another target")
+        return await texts[key]
+
+    # Other targets wait for this result instead of processing the text
+    future = asyncio.get_running_loop().create_future()
+    texts[key] = future
+
+    try:
+        text, translated = await process_text(target, text, is_caption)
+    except BaseException as e:
+        texts.pop(key, None)
+        if isinstance(e, Exception):
+            future.set_exception(e)
+            future.exception()  # Don't warn if nobody else was waiting
+        else:
+            future.cancel()
+        raise
+    # If the translation failed, the next targets try again, the ones
+    # already waiting send the text untranslated
+    if not translated:
+        texts.pop(key, None)
+    future.set_result(text)
+    return text
+
 
+async def process_text(target: dict, text: str,
+                       is_caption: bool) -> tuple[str, bool]:
+    """Replace words, select text with regex and translate it
+
+    Returns the text, and False if its translation failed.
+    """
     logger.debug(f"Replace mode is: {target['replace_words_mode']}")
-    for word in words:
-        # Replace only boundary words matches
-        if target["replace_words_mode"] == "word_boundary_match":
-            sub_word = word
-            # If the word starts with
-            if word[0] in ["@", "#", "$"]:
-                sub_word = word[1:]
-                symbol = word[0]
-                pattern = r"[%s]\b%s\b" % (symbol, sub_word)
-            # If the word ends with
-            elif word[-1] in ["@", "#", "$"]:
-                sub_word = word[:-1]
-                symbol = word[-1]
-                pattern = r"\b%s[%s]" % (sub_word, symbol)
-            else:
-                pattern = r"\b%s\b" % word
-            text = re.sub(pattern, words[word], text, flags=re.I)
-        # Replace any match
-        else:
-            text = re.sub(word, words[word], text, flags=re.I)
-
-    # Select a match with regex
-    for pattern in target["patterns"]:
-        if re.search(pattern["pattern"], text, re.DOTALL):
-            logger.debug(f"Pattern '{pattern['name']}' found in text")
-            text = re.search(pattern["pattern"], text, re.DOTALL)
-            text = text.group(pattern["group"])
-            break
+    rewriter = await get_rewriter(target)
+    # Replace the words, then select a match with regex
+    text = rewriter.select(rewriter.replace(text))
 
     if target["translate"]:
         translated_text = await translate(
@@ -187,52 +330,53 @@ async def replace_words(target: dict, text: str,
             target["translate_show_original"],
             target["translate_original_prefix"],
             target["translate_translation_prefix"])
+        if translated_text is None:
+            logger.debug("Returning the text untranslated")
+            return text, False
         if is_caption and len(translated_text) <= 1024:
             text = translated_text
         elif not is_caption and len(translated_text) <= 4096:
             text = translated_text
 
     logger.debug("Returning text")
-    return text
+    return text, True
 
 
 async def forward_message(message: Message, target: dict, edited=False,
-                          media_group=False):
-    """Forward a message to a target"""
-    msg_ids = await Messages.get_message_ids()
+                          media_group=False, album: list | None = None):
+    """Forward a message to a target
+
+    `album` are the messages of the media group, if they are known.
+    """
     target = str(target["target"])
     source = str(message.chat.id)
     ids = message.id
 
     if media_group:
-        messages = await user.get_media_group(source, message.id)
+        messages = album or await user.get_media_group(source, message.id)
         ids = [msg.id for msg in messages]
 
     if edited:
-        origin_edit_id = str(message.id)
-        edit_id = -1
+        edit_id = await Messages.get_message_id(target, source, message.id)
         can_edit = True
-        # If the message id is in the list of messages ids
-        if target in msg_ids and source in msg_ids[target] and origin_edit_id\
-                in msg_ids[target][source]:
-            edit_id = msg_ids[target][source][origin_edit_id]
-        else:
+        # If the message id is not in the list of messages ids
+        if edit_id is None:
+            edit_id = -1
             can_edit = False
             logger.error("The message cannot be deleted, because it does " +
                          "not exist in the target chat")
         if media_group and can_edit:
-            edit_id = [msg_ids[target][source][str(id)] for id in ids]
+            edit_id = [await Messages.get_message_id(target, source, id)
+                       for id in ids]
+            edit_id = [id for id in edit_id if id is not None]
         if edit_id != -1:
-            deleted_id = await user.get_messages(target, edit_id)
             # Remove message, to resend it already edited
-            if media_group:
-                await on_deleted_message(user, deleted_id)
-            else:
-                await on_deleted_message(user, [deleted_id])
-        await user.delete_messages(target, edit_id)
+            edit_ids = edit_id if media_group else [edit_id]
+            await delete_copies([(int(target), id) for id in edit_ids])
+        await sender.delete_messages(target, edit_id)
 
     if not message.chat.has_protected_content:
-        msg = await user.forward_messages(target, source, ids)
+        msg = await sender.forward_messages(target, source, ids)
         from_user = message.chat.title if message.chat.title else\
             message.chat.first_name
 
@@ -253,18 +397,38 @@ async def forward_message(message: Message, target: dict, edited=False,
     else:
         await Messages.add_message_id(target, source, message.id, msg.id)
 
+    if not edited:
+        remember_last(target, msg)
+
     if media_group and edited:
-        await on_media_group_edited(user, msg[0])
+        cascade(on_media_group_edited, msg[0])
     elif media_group:
-        await on_media_group(user, msg[0])
+        spawn(send_album(msg))
     else:
-        await on_new_message(user, msg)
+        cascade(on_new_message, msg)
 
 
-async def copy_message(message: Message, target: dict, edited=False,
-                       pinned=False, reply=False, media_group=False):
+async def copy_message(message: Message, target: dict, **kwargs):
     """Copy a message to a target"""
-    msg_ids = await Messages.get_message_ids()
+    downloads = []
+    try:
+        await send_copy(message, target, downloads, **kwargs)
+    finally:
+        # Release the media downloaded from chats with protected content
+        for downloaded in downloads:
+            spool.release(downloaded)
+
+
+async def send_copy(message: Message, target: dict, downloads: list,
+                    edited=False, pinned=False, reply=False,
+                    media_group=False, album: list | None = None,
+                    texts: dict | None = None, checks: dict | None = None):
+    """Send the copy of a message to a target
+
+    `album` are the messages of the media group, if they are known, `texts`
+    the texts processed for the other targets, see replace_words, and
+    `checks` the images checked for them, see is_image_blocked.
+    """
     forwarder = target
     target = str(target["target"])
     source = str(message.chat.id)
@@ -272,17 +436,17 @@ async def copy_message(message: Message, target: dict, edited=False,
         message.chat.first_name
 
     if pinned:
-        origin_pinned_id = str(message.pinned_message.id)
-        pinned_id = -1
+        origin_pinned_id = message.pinned_message.id
         to_user = await user.get_chat(target)
         to_user = to_user.title if to_user.title else to_user.first_name
 
-        # If the message id is in the list of messages ids
-        if target in msg_ids and source in msg_ids[target] and\
-                origin_pinned_id in msg_ids[target][source]:
-            pinned_id = msg_ids[target][source][origin_pinned_id]
+        pinned_id = await Messages.get_message_id(target, source,
+                                                  origin_pinned_id)
+        # If the message id is not in the list of messages ids
+        if pinned_id is None:
+            pinned_id = -1
         try:
-            await user.pin_chat_message(target, pinned_id, both_sides=True)
+            await sender.pin_chat_message(target, pinned_id, both_sides=True)
             logger.info(f"Pinning message from {from_user} to {to_user}")
         except MessageIdInvalid:
             logger.error("The message cannot be pinned, because it does not " +
@@ -290,21 +454,26 @@ async def copy_message(message: Message, target: dict, edited=False,
         return
 
     elif media_group:
-        messages = await user.get_media_group(source, message.id)
+        messages = album or await user.get_media_group(source, message.id)
         media_input = []
-        downloaded_media = []
+        # The files of the media group are downloaded one after another, so
+        # their space in the spool is reserved before the first one
+        if message.chat.has_protected_content:
+            await spool.reserve(messages)
+            downloads.append(messages[0])
 
         for msg_media in messages:
-            text = await replace_words(forwarder, msg_media.caption, True)
+            text = await replace_words(forwarder, msg_media.caption, True,
+                                       texts)
             entities = msg_media.caption_entities
             # If the chat has protected content, download the media to send it
             if msg_media.chat.has_protected_content:
-                path = await msg_media.download()
+                path = await spool.acquire(msg_media, upload=True)
+                downloads.append(msg_media)
             # If the chat has not protected content, get the file_id to send it
             else:
                 path = await get_media_type(msg_media)
 
-            downloaded_media.append(path)
             if msg_media.media is MessageMediaType.PHOTO:
                 media_input.append(InputMediaPhoto(path, text))
             elif msg_media.media is MessageMediaType.VIDEO:
@@ -318,11 +487,11 @@ async def copy_message(message: Message, target: dict, edited=False,
 
         reply_id = None
         if reply:
-            src_reply_id = str(message.reply_to_message.id)
+            src_reply_id = message.reply_to_message.id
+            reply_id = await Messages.get_message_id(target, source,
+                                                     src_reply_id)
             # If the message id is in the list of messages ids
-            if target in msg_ids and source in msg_ids[target] and\
-                    src_reply_id in msg_ids[target][source]:
-                reply_id = msg_ids[target][source][src_reply_id]
+            if reply_id is not None:
                 logger.debug(f"Replying to message: {reply_id}")
             else:
                 logger.error("The reply message cannot be forwarded, " +
@@ -330,40 +499,31 @@ async def copy_message(message: Message, target: dict, edited=False,
                 return
 
         if forwarder["send_text_only"]:
-            msg = await user.send_message(target, text, entities=entities,
-                                          reply_to_message_id=reply_id)
+            msg = await sender.send_message(target, text, entities=entities,
+                                            reply_to_message_id=reply_id)
             await Messages.add_message_id(target, source, messages[0].id,
                                           msg.id)
         else:
-            msg = await user.send_media_group(target, media_input,
-                                              reply_to_message_id=reply_id)
+            msg = await sender.send_media_group(target, media_input,
+                                                reply_to_message_id=reply_id)
             for old_msg, new_msg in zip(messages, msg):
                 await Messages.add_message_id(target, source, old_msg.id,
                                               new_msg.id)
+                await save_upload(old_msg, new_msg)
 
         to_user = msg[0].chat.title if msg[0].chat.title else\
             msg[0].chat.first_name
         logger.info(f"Copying media group from {from_user} to {to_user}")
 
-        for path in downloaded_media:
-            if os.path.isfile(path):
-                logger.debug(f"Removing file {path}")
-                os.remove(path)
-
     elif message.media is not None:
-        downloadable_media = [MessageMediaType.PHOTO, MessageMediaType.VIDEO,
-                              MessageMediaType.AUDIO, MessageMediaType.VOICE,
-                              MessageMediaType.DOCUMENT,
-                              MessageMediaType.ANIMATION,
-                              MessageMediaType.VIDEO_NOTE,
-                              MessageMediaType.STICKER]
-        text = await replace_words(forwarder, message.caption, True)
+        text = await replace_words(forwarder, message.caption, True,
+                                   texts)
         entities = message.caption_entities
         reply_id = None
 
-        if message.media in downloadable_media:
+        if message.media in DOWNLOADABLE_MEDIA:
             if message.media is MessageMediaType.PHOTO:
-                if await is_image_blocked(message):
+                if await is_image_blocked(message, checks):
                     logger.error("The image is blocked")
                     return
 
@@ -371,18 +531,19 @@ async def copy_message(message: Message, target: dict, edited=False,
             if message.chat.has_protected_content:
                 logger.debug(f"{from_user} has protected content, "
                              "downloading media")
-                path = await message.download()
+                path = await spool.acquire(message, upload=True)
+                downloads.append(message)
             else:
                 logger.debug(f"{from_user} has no protected content, "
                              "using file_id")
                 path = await get_media_type(message)
 
         if reply:
-            src_reply_id = str(message.reply_to_message_id)
+            src_reply_id = message.reply_to_message_id
+            reply_id = await Messages.get_message_id(target, source,
+                                                     src_reply_id)
             # If the message id is in the list of messages ids
-            if target in msg_ids and source in msg_ids[target] and\
-                    src_reply_id in msg_ids[target][source]:
-                reply_id = msg_ids[target][source][src_reply_id]
+            if reply_id is not None:
                 logger.debug(f"Replying to message: {reply_id}")
             # If the chat has not protected content, get the file_id to send it
             else:
@@ -391,12 +552,11 @@ async def copy_message(message: Message, target: dict, edited=False,
                 return
 
         if edited:
-            origin_edit_id = str(message.id)
-            edit_id = -1
-            # If the message id is in the list of messages ids
-            if target in msg_ids and source in msg_ids[target] and\
-                    origin_edit_id in msg_ids[target][source]:
-                edit_id = msg_ids[target][source][origin_edit_id]
+            edit_id = await Messages.get_message_id(target, source,
+                                                    message.id)
+            # If the message id is not in the list of messages ids
+            if edit_id is None:
+                edit_id = -1
             if message.media is MessageMediaType.PHOTO:
                 media = InputMediaPhoto(path, text)
             elif message.media is MessageMediaType.VIDEO:
@@ -410,19 +570,22 @@ async def copy_message(message: Message, target: dict, edited=False,
 
             try:
                 if message.media is MessageMediaType.WEB_PAGE:
-                    text = await replace_words(forwarder, message.text)
-                    msg = await user.edit_message_text(target, edit_id, text,
-                                                       entities=entities)
+                    text = await replace_words(forwarder, message.text,
+                                               texts=texts)
+                    msg = await sender.edit_message_text(target, edit_id, text,
+                                                         entities=entities)
                     to_user = msg.chat.title if msg.chat.title else\
                         msg.chat.first_name
                     logger.info(f"Editing media from {from_user} to {to_user}")
                 else:
-                    msg = await user.edit_message_media(target, edit_id, media)
+                    msg = await sender.edit_message_media(target, edit_id,
+                                                          media)
+                    await save_upload(message, msg)
                     to_user = msg.chat.title if msg.chat.title else\
                         msg.chat.first_name
                     logger.info(f"Editing media from {from_user} to {to_user}")
                     if entities is not None:
-                        await user.edit_message_caption(
+                        await sender.edit_message_caption(
                             target, edit_id, text, caption_entities=entities)
             except MessageIdInvalid:
                 logger.error("The media cannot be edited, because it does " +
@@ -435,67 +598,70 @@ async def copy_message(message: Message, target: dict, edited=False,
 
         else:
             if forwarder["send_text_only"] and text != "":
-                msg = await user.send_message(target, text, entities=entities,
-                                              reply_to_message_id=reply_id)
+                msg = await sender.send_message(target, text,
+                                                entities=entities,
+                                                reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.PHOTO:
-                msg = await user.send_photo(target, path, text,
-                                            caption_entities=entities,
-                                            reply_to_message_id=reply_id)
+                msg = await sender.send_photo(target, path, text,
+                                              caption_entities=entities,
+                                              reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.AUDIO:
-                msg = await user.send_audio(target, path, text,
-                                            caption_entities=entities,
-                                            reply_to_message_id=reply_id)
+                msg = await sender.send_audio(target, path, text,
+                                              caption_entities=entities,
+                                              reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.DOCUMENT:
-                msg = await user.send_document(target, path, caption=text,
-                                               caption_entities=entities,
-                                               reply_to_message_id=reply_id)
+                msg = await sender.send_document(target, path, caption=text,
+                                                 caption_entities=entities,
+                                                 reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.STICKER:
-                msg = await user.send_sticker(target, path,
-                                              reply_to_message_id=reply_id)
+                msg = await sender.send_sticker(target, path,
+                                                reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.VIDEO:
-                msg = await user.send_video(target, path, text,
-                                            caption_entities=entities,
-                                            reply_to_message_id=reply_id)
+                msg = await sender.send_video(target, path, text,
+                                              caption_entities=entities,
+                                              reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.ANIMATION:
-                msg = await user.send_animation(target, path, text,
-                                                caption_entities=entities,
-                                                reply_to_message_id=reply_id)
+                msg = await sender.send_animation(target, path, text,
+                                                  caption_entities=entities,
+                                                  reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.VOICE:
-                msg = await user.send_voice(target, path, text,
-                                            caption_entities=entities,
-                                            reply_to_message_id=reply_id)
+                msg = await sender.send_voice(target, path, text,
+                                              caption_entities=entities,
+                                              reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.VIDEO_NOTE:
-                msg = await user.send_video_note(target, path,
-                                                 reply_to_message_id=reply_id)
+                msg = await sender.send_video_note(
+                    target, path, reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.LOCATION:
                 latitude = message.location.latitude
                 longitude = message.location.longitude
-                msg = await user.send_location(target, latitude, longitude,
-                                               reply_to_message_id=reply_id)
+                msg = await sender.send_location(target, latitude, longitude,
+                                                 reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.VENUE:
                 latitude = message.venue.location.latitude
                 longitude = message.venue.location.longitude
                 title = message.venue.title
                 address = message.venue.address
-                msg = await user.send_venue(target, latitude, longitude, title,
-                                            address,
-                                            reply_to_message_id=reply_id)
+                msg = await sender.send_venue(target, latitude, longitude,
+                                              title, address,
+                                              reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.CONTACT:
                 phone_number = message.contact.phone_number
                 first_name = message.contact.first_name
                 last_name = message.contact.last_name
-                msg = await user.send_contact(target, phone_number,
-                                              first_name, last_name,
-                                              reply_to_message_id=reply_id)
+                msg = await sender.send_contact(target, phone_number,
+                                                first_name, last_name,
+                                                reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.DICE:
                 emoji = message.dice.emoji
-                msg = await user.send_dice(target, emoji,
-                                           reply_to_message_id=reply_id)
+                msg = await sender.send_dice(target, emoji,
+                                             reply_to_message_id=reply_id)
             elif message.media is MessageMediaType.WEB_PAGE:
                 entities = message.entities
-                text = await replace_words(forwarder, message.text)
-                msg = await user.send_message(target, text, entities=entities,
-                                              reply_to_message_id=reply_id)
+                text = await replace_words(forwarder, message.text,
+                                           texts=texts)
+                msg = await sender.send_message(target, text,
+                                                entities=entities,
+                                                reply_to_message_id=reply_id)
             # Only will be sent if the poll type is regular
             elif message.media is MessageMediaType.POLL and\
                     message.poll.type is PollType.REGULAR:
@@ -505,10 +671,10 @@ async def copy_message(message: Message, target: dict, edited=False,
                 type = message.poll.type
                 allows_multiple_answers = message.poll.allows_multiple_answers
                 try:
-                    msg = await user.send_poll(target, question, options,
-                                               is_anonymous, type,
-                                               allows_multiple_answers,
-                                               reply_to_message_id=reply_id)
+                    msg = await sender.send_poll(target, question, options,
+                                                 is_anonymous, type,
+                                                 allows_multiple_answers,
+                                                 reply_to_message_id=reply_id)
                 except MediaInvalid:
                     logger.error("The poll could not be sent. Maybe the " +
                                  "target is a private chat?")
@@ -539,11 +705,11 @@ async def copy_message(message: Message, target: dict, edited=False,
 
                 # Send the quiz
                 try:
-                    msg = await user.send_poll(target, question, options,
-                                               is_anonymous, type,
-                                               allows_multiple_answers,
-                                               correct_option, explanation,
-                                               reply_to_message_id=reply_id)
+                    msg = await sender.send_poll(target, question, options,
+                                                 is_anonymous, type,
+                                                 allows_multiple_answers,
+                                                 correct_option, explanation,
+                                                 reply_to_message_id=reply_id)
                 except MediaInvalid:
                     logger.error("The poll could not be sent. Maybe the " +
                                  "target is a private chat?")
@@ -552,30 +718,26 @@ async def copy_message(message: Message, target: dict, edited=False,
             to_user = msg.chat.title if msg.chat.title else msg.chat.first_name
             logger.info(f"Sending media from {from_user} to {to_user}")
             await Messages.add_message_id(target, source, message.id, msg.id)
-
-        if message.media in downloadable_media:
-            if os.path.isfile(path):
-                logger.debug(f"Removing file {path}")
-                os.remove(path)
+            await save_upload(message, msg)
 
     # If the message is just a text message
     else:
-        text = await replace_words(forwarder, message.text)
+        text = await replace_words(forwarder, message.text, texts=texts)
         entities = message.entities
         reply_id = None
 
         if not forwarder["duplicated_text"]:
-            if await is_identical_to_last(message, target):
+            if await is_identical_to_last(text, target):
                 logger.debug("The message is identical to the last message, " +
                              "skipping")
                 return
 
         if reply:
-            src_reply_id = str(message.reply_to_message_id)
+            src_reply_id = message.reply_to_message_id
+            reply_id = await Messages.get_message_id(target, source,
+                                                     src_reply_id)
             # If the message id is in the list of messages ids
-            if target in msg_ids and source in msg_ids[target] and\
-                    src_reply_id in msg_ids[target][source]:
-                reply_id = msg_ids[target][source][src_reply_id]
+            if reply_id is not None:
                 logger.debug(f"Replying to message: {reply_id}")
             else:
                 logger.error("The message cannot be replied, because it " +
@@ -583,13 +745,13 @@ async def copy_message(message: Message, target: dict, edited=False,
                 return
 
         if edited:
-            origin_edit_id = str(message.id)
-            edit_id = -1
-            if target in msg_ids and origin_edit_id in msg_ids[target][source]:
-                edit_id = msg_ids[target][source][origin_edit_id]
+            edit_id = await Messages.get_message_id(target, source,
+                                                    message.id)
+            if edit_id is None:
+                edit_id = -1
             try:
-                msg = await user.edit_message_text(target, edit_id, text,
-                                                   entities=entities)
+                msg = await sender.edit_message_text(target, edit_id, text,
+                                                     entities=entities)
                 to_user = msg.chat.title if msg.chat.title else\
                     msg.chat.first_name
                 logger.info(f"Editing message from {from_user} to {to_user}")
@@ -603,87 +765,248 @@ async def copy_message(message: Message, target: dict, edited=False,
                 return
 
         else:
-            msg = await user.send_message(target, text, entities=entities,
-                                          reply_to_message_id=reply_id)
+            msg = await sender.send_message(target, text, entities=entities,
+                                            reply_to_message_id=reply_id)
             to_user = msg.chat.title if msg.chat.title else msg.chat.first_name
             logger.info(f"Sending message from {from_user} to {to_user}")
             await Messages.add_message_id(target, source, message.id, msg.id)
 
+    if not edited:
+        remember_last(target, msg)
+
     # Call messages function to handle the new message
-    if media_group and reply:
-        await on_media_group_reply(user, msg[0])
-    elif media_group:
-        await on_media_group(user, msg[0])
+    # With send_text_only, the copy of a media group is a text message
+    if media_group and isinstance(msg, list):
+        spawn(send_album(msg, reply))
     elif reply:
-        await on_message_reply(user, msg)
+        cascade(on_message_reply, msg)
     elif edited:
-        await on_message_edited(user, msg)
+        cascade(on_message_edited, msg)
     else:
-        await on_new_message(user, msg)
+        cascade(on_new_message, msg)
+
 
+def remember_last(target: str, sent: Message | list):
+    """Save the text of the last message sent to a target"""
+    if isinstance(sent, list):
+        sent = sent[-1]
+    last_texts.set(target, sent.text)
 
-async def get_targets(event: Message, media_group=False):
-    """Get the target chats for the message"""
+
+def cascade(handler, message: Message):
+    """Handle the copy of a message, if the target is also a source chat
+
+    The handler runs in its own task, a send waiting for the sends of its
+    copy could wait for itself.
+    """
+    spawn(handler(user, message))
+
+
+def spawn(coroutine):
+    """Run a coroutine in the background"""
+    task = asyncio.create_task(coroutine)
+    background.add(task)
+    task.add_done_callback(background.discard)
+
+
+async def get_blocked(event: Message, targets: set,
+                      media_group=False) -> set:
+    """Get the targets of the forwarders that block words of the message"""
+    blocked_words = await Forwardings.get_derived(
+        "blocked_words", lambda config: BlockedWords(config["forwarders"]))
+
+    if media_group:
+        texts = [message.caption for message in event]
+    else:
+        texts = [event.caption, event.text]
+
+    return blocked_words.search(texts, targets)
+
+
+async def get_targets(event: Message, media_group=False, dedupe=False,
+                      reply=False):
+    """Get the target chats for the message
+
+    If `reply` is True, the forwarders with replies disabled are skipped. If
+    `dedupe` is True, the forwarders with dedupe enabled skip the messages
+    whose content they sent recently.
+    """
     targets = []
-    source = event.chat.id
-    forwarding_ids = await Forwardings.get_forwarding_ids()
-    config = await Forwardings.get_config()
-    outgoing = event.outgoing
-
-    if source in forwarding_ids:
-        for forwarder in config["forwarders"]:
-            next_forwarder = False
-
-            for word in forwarder["blocked_words"]:
-                if media_group:
-                    for message in event:
-                        if message.caption is not None:
-                            if word.lower() in message.caption.lower():
-                                next_forwarder = True
-                                break
-                        if next_forwarder:
-                            break
-                else:
-                    if event.caption is not None:
-                        if word.lower() in event.caption.lower():
-                            next_forwarder = True
-                            break
-                    if event.text is not None:
-                        if word.lower() in event.text.lower():
-                            next_forwarder = True
-                            break
-
-            if next_forwarder:
-                continue
-            if forwarder["enabled"]:
-                # If forward outgoing messages is disabled, add the message ID
-                # to messages.json
-                if outgoing and not forwarder["outgoing"]:
-                    await Messages.add_message_id(str(forwarder["target"]),
-                                                  str(source), event.id,
-                                                  event.id)
-                    continue
-                # If forward incoming messages is disabled, add the message ID
-                # to messages.json
-                if not outgoing and not forwarder["incoming"]:
-                    await Messages.add_message_id(str(forwarder["target"]),
-                                                  str(source), event.id,
-                                                  event.id)
-                    continue
-                if source in [int(src) for src in forwarder["source"].keys()]:
-                    targets.append(forwarder)
+    # A media group is given as the list of its messages
+    messages = event if media_group else [event]
+    source = messages[0].chat.id
+    routes = await Forwardings.get_routes()
+    direction = "outgoing" if messages[0].outgoing else "incoming"
+
+    if source not in routes:
+        return targets
+    route = routes[source]
+
+    # Forwarders with blocked words in the message
+    candidates = {forwarder["target"] for forwarder in
+                  route[direction] + route[f"muted_{direction}"]}
+    blocked = await get_blocked(event, candidates, media_group)
+
+    # If forwarding messages in this direction is disabled, add the message
+    # ID to messages.json
+    for forwarder in route[f"muted_{direction}"]:
+        if forwarder["target"] in blocked:
+            continue
+        for message in messages:
+            await Messages.add_message_id(str(forwarder["target"]),
+                                          str(source), message.id, message.id)
+
+    for forwarder in route[direction]:
+        if forwarder["target"] in blocked:
+            continue
+        # Before the dedupe, that records the content as sent
+        if reply and not forwarder["reply"]:
+            continue
+        if dedupe and is_duplicate(messages, forwarder):
+            logger.debug(f"The message was already sent to "
+                         f"{forwarder['target']} recently, skipping")
+            continue
+        targets.append(forwarder)
 
     return targets
 
 
+def is_duplicate(messages: list, forwarder: dict) -> bool:
+    """Check if the forwarder sent the same content recently"""
+    if not forwarder.get("dedupe", False):
+        return False
+
+    keys = [fingerprint(message) for message in messages]
+    if None in keys:
+        return False
+    # The messages of a media group are a single content
+    key = keys[0] if len(keys) == 1 else hash(tuple(sorted(keys)))
+
+    seen = recent_contents.setdefault(forwarder["target"], RecentSet())
+    return seen.add(key, forwarder.get("dedupe_window", 600))
+
+
+async def dispatch(function, message: Message, target: dict,
+                   delivery: int | None = None, album: list | None = None,
+                   texts: dict | None = None, checks: dict | None = None,
+                   **kwargs) -> asyncio.Future:
+    """Queue the send of a message to a target
+
+    The delivery is written to the outbox first, unless it's already there.
+    The album, the processed texts and the checked images are not written,
+    if the delivery is replayed they are fetched, processed and checked
+    again. The
+    media uploaded again from protected chats goes to the bulk lane, the
+    rest to the fast lane.
+    """
+    source = message.chat.id
+    if delivery is None:
+        mode = "copy" if function is copy_message else "forward"
+        delivery = outbox.add(source, message.id, target["target"], mode,
+                              kwargs)
+    messages = album or [message]
+    if album is not None:
+        kwargs["album"] = album
+    if texts is not None:
+        kwargs["texts"] = texts
+    if checks is not None:
+        kwargs["checks"] = checks
+    pinned_id = message.pinned_message.id if message.pinned_message else None
+    refs = {(source, id) for id in (message.reply_to_message_id, pinned_id)
+            if id is not None}
+    refs.update((source, msg.id) for msg in messages)
+    upload = target["forwarding_mode"] == "copy" and\
+        message.chat.has_protected_content and\
+        any(msg.media in DOWNLOADABLE_MEDIA for msg in messages)
+    return await scheduler.submit(target["target"],
+                                  "bulk" if upload else "fast", refs,
+                                  deliver, delivery, function, message,
+                                  target, **kwargs)
+
+
+async def deliver(delivery: int, function, message: Message, target: dict,
+                  **kwargs):
+    """Send a delivery of the outbox, and try again later if it fails"""
+    try:
+        await function(message, target, **kwargs)
+    except TRANSIENT_ERRORS as e:
+        delay = outbox.failed(delivery, e)
+        if delay is None:
+            raise
+        logger.warning(f"The message could not be sent to {target['target']}"
+                       f", trying again in {delay} seconds: {e}")
+        spawn(redeliver(delay, delivery, function, message, target,
+                        **kwargs))
+        return
+    except Exception:
+        outbox.done(delivery)
+        raise
+    outbox.done(delivery)
+
+
+async def redeliver(delay: float, delivery: int, function, message: Message,
+                    target: dict, **kwargs):
+    """Queue a delivery of the outbox again after some seconds"""
+    await asyncio.sleep(delay)
+    await dispatch(function, message, target, delivery, **kwargs)
+
+
+async def replay_outbox():
+    """Queue the deliveries left in the outbox by the last run"""
+    pending = outbox.pending()
+    if not pending:
+        return
+    logger.info(f"Sending {len(pending)} deliveries left in the outbox")
+
+    # The messages are fetched again, up to 200 per request
+    ids = {}
+    for _, source, message_id, *_ in pending:
+        ids.setdefault(source, set()).add(message_id)
+    messages = {}
+    for source, message_ids in ids.items():
+        message_ids = sorted(message_ids)
+        for i in range(0, len(message_ids), 200):
+            try:
+                for message in await user.get_messages(
+                        source, message_ids[i:i + 200]):
+                    messages[(source, message.id)] = message
+            except Exception as e:
+                logger.error(f"The messages of {source} could not be "
+                             f"fetched: {e}")
+
+    for delivery, source, message_id, target, mode, flags, delay in pending:
+        message = messages.get((source, message_id))
+        forwarder = await Forwardings.get_forwarder(str(target))
+        if message is None or message.empty or forwarder is None:
+            logger.error(f"The delivery of {message_id} from {source} to "
+                         f"{target} can't be sent anymore")
+            outbox.done(delivery)
+            continue
+
+        function = copy_message if mode == "copy" else forward_message
+        spawn(redeliver(delay, delivery, function, message, forwarder,
+                        **flags))
+
+
 @user.on_edited_message(filters.create(is_forwarder) & ~filters.media_group)
 async def on_message_edited(client: Client, message: Message):
     """Handle edited messages"""
-    for target in await get_targets(message):
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target, edited=True)
-        else:
-            await forward_message(message, target, edited=True)
+    jobs = []
+    # Texts processed and images checked for the targets of this message,
+    # see replace_words and is_image_blocked
+    texts = {}
+    checks = {}
+    # The targets share the media downloaded from protected chats, until
+    # they are sent
+    with spool.sharing(message, jobs):
+        for target in await get_targets(message):
+            if target["forwarding_mode"] == "copy":
+                jobs.append(await dispatch(
+                    copy_message, message, target, edited=True,
+                    texts=texts, checks=checks))
+            else:
+                jobs.append(await dispatch(
+                    forward_message, message, target, edited=True))
 
 
 @user.on_message(filters.create(is_forwarder) & filters.pinned_message &
@@ -691,109 +1014,161 @@ async def on_message_edited(client: Client, message: Message):
 async def on_message_pinned(client: Client, message: Message):
     """Handle pinned messages"""
     for target in await get_targets(message):
-        await copy_message(message, target, pinned=True)
+        await dispatch(copy_message, message, target, pinned=True)
 
 
 @user.on_message(filters.create(is_forwarder) & filters.reply &
                  ~filters.media_group)
 async def on_message_reply(client: Client, message: Message):
     """Handle the reply to a message"""
-    for target in await get_targets(message):
-        if not target["reply"]:  # If the reply is disabled, continue
-            continue
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target, reply=True)
-        else:
-            await forward_message(message, target)
+    jobs = []
+    # Texts processed and images checked for the targets of this message,
+    # see replace_words and is_image_blocked
+    texts = {}
+    checks = {}
+    # The targets share the media downloaded from protected chats, until
+    # they are sent
+    with spool.sharing(message, jobs):
+        for target in await get_targets(message, dedupe=True, reply=True):
+            if target["forwarding_mode"] == "copy":
+                jobs.append(await dispatch(
+                    copy_message, message, target, reply=True,
+                    texts=texts, checks=checks))
+            else:
+                jobs.append(await dispatch(
+                    forward_message, message, target))
 
 
 @user.on_message(filters.create(is_forwarder) & ~filters.media_group)
 async def on_new_message(client: Client, message: Message):
     """Handle new messages"""
-    for target in await get_targets(message):
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target)
-        else:
-            await forward_message(message, target)
+    jobs = []
+    # Texts processed and images checked for the targets of this message,
+    # see replace_words and is_image_blocked
+    texts = {}
+    checks = {}
+    # The targets share the media downloaded from protected chats, until
+    # they are sent
+    with spool.sharing(message, jobs):
+        for target in await get_targets(message, dedupe=True):
+            if target["forwarding_mode"] == "copy":
+                jobs.append(await dispatch(
+                    copy_message, message, target, texts=texts,
+                    checks=checks))
+            else:
+                jobs.append(await dispatch(
+                    forward_message, message, target))
 
 
 @user.on_message(filters.create(is_forwarder) & filters.media_group &
                  filters.reply)
 async def on_media_group_reply(client: Client, message: Message):
     """Handle reply media groups messages"""
-    global current_media_group
-    if current_media_group == message.media_group_id:
-        return
-
-    current_media_group = message.media_group_id
-    for target in await get_targets(message):
-        if not target["reply"]:  # If the reply is disabled, continue
-            continue
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target, media_group=True, reply=True)
-        else:
-            await forward_message(message, target)
+    album = await albums.collect(message)
+    # Only the first message of the media group gets the whole group
+    if album is not None:
+        await send_album(album, reply=True)
 
 
 @user.on_edited_message(filters.create(is_forwarder) & filters.media_group)
 async def on_media_group_edited(client: Client, message: Message):
     """Handle edited media group messages"""
-    for target in await get_targets(message):
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target, edited=True)
-        else:
-            await forward_message(message, target, media_group=True,
-                                  edited=True)
+    album = None
+    jobs = []
+    # Texts processed and images checked for the targets of this message,
+    # see replace_words and is_image_blocked
+    texts = {}
+    checks = {}
+    # The targets share the media downloaded from protected chats, until
+    # they are sent
+    with spool.sharing(message, jobs):
+        for target in await get_targets(message):
+            if target["forwarding_mode"] == "copy":
+                jobs.append(await dispatch(
+                    copy_message, message, target, edited=True,
+                    texts=texts, checks=checks))
+            else:
+                # The media group is fetched once for every target
+                if album is None:
+                    album = await user.get_media_group(message.chat.id,
+                                                       message.id)
+                jobs.append(await dispatch(
+                    forward_message, message, target, album=album,
+                    media_group=True, edited=True))
 
 
 @user.on_message(filters.create(is_forwarder) & filters.media_group)
 async def on_media_group(client: Client, message: Message):
     """Handle media group messages"""
-    global current_media_group
-    if current_media_group == message.media_group_id:
-        return
-
-    current_media_group = message.media_group_id
-    for target in await get_targets(message):
-        if target["forwarding_mode"] == "copy":
-            await copy_message(message, target, media_group=True)
-        else:
-            await forward_message(message, target, media_group=True)
+    album = await albums.collect(message)
+    # Only the first message of the media group gets the whole group
+    if album is not None:
+        await send_album(album)
+
+
+async def send_album(album: list, reply=False):
+    """Send the messages of a media group to its targets"""
+    message = album[0]
+    jobs = []
+    # Texts processed and images checked for the targets of this message,
+    # see replace_words and is_image_blocked
+    texts = {}
+    checks = {}
+    # The targets share the media downloaded from protected chats, until
+    # they are sent
+    with spool.sharing(message, jobs):
+        for target in await get_targets(album, media_group=True,
+                                        dedupe=True, reply=reply):
+            if target["forwarding_mode"] == "copy":
+                jobs.append(await dispatch(
+                    copy_message, message, target, album=album,
+                    media_group=True, reply=reply, texts=texts,
+                    checks=checks))
+            else:
+                jobs.append(await dispatch(
+                    forward_message, message, target, album=album,
+                    media_group=True))
 
 
 @user.on_deleted_messages()
 async def on_deleted_message(client: Client, messages: list[Message]):
-    msg_ids = await Messages.get_message_ids()
-    deleted_msg = []
-    deleted_ids = []
-    # If the message comes from a private chat
-    if messages[0].chat is None:
-        for message in messages:
-            msg_id = str(message.id)
-            for target in msg_ids:
-                for source in msg_ids[target]:
-                    if msg_id in msg_ids[target][source]:
-                        del_id = msg_ids[target][source][msg_id]
-                        msg_deleted = await client.get_messages(target, del_id)
-                        deleted_msg.append(msg_deleted)
-                        deleted_ids.append(del_id)
-    # If the message comes from a group or channel
-    else:
-        for message in messages:
-            msg_id = str(message.id)
-            chat = str(message.chat.id)
-            for target in msg_ids:
-                if chat in msg_ids[target] and msg_id in msg_ids[target][chat]:
-                    del_id = msg_ids[target][chat][msg_id]
-                    msg_deleted = await client.get_messages(target, del_id)
-                    deleted_msg.append(msg_deleted)
-                    deleted_ids.append(del_id)
-
-    # If there are messages to delete
-    if len(deleted_msg) > 0 and msg_deleted.chat is not None:
-        target = msg_deleted.chat.id
-        from_user = msg_deleted.chat.title if msg_deleted.chat.title else\
-            msg_deleted.chat.first_name
-        logger.info(f"Removing messages from {from_user}")
-        await user.delete_messages(target, deleted_ids)
-        await on_deleted_message(user, deleted_msg)
+    """Handle deleted messages"""
+    # If the message comes from a private chat, the chat is unknown
+    deleted = [(message.chat.id if message.chat else None, message.id)
+               for message in messages]
+    await delete_copies(deleted, queued=True)
+
+
+async def delete_copies(deleted: list, seen: set | None = None,
+                        queued: bool = False):
+    """Delete the copies of the given (chat_id, message_id) messages
+
+    If chat_id is None, the copies of the message in every source chat are
+    deleted. The copies are deleted in a single call per target, and then
+    the copies of the copies, if the target is also a source chat. If
+    `queued` is True, the deletions go to the fast lane of the targets.
+    """
+    seen = set() if seen is None else seen
+    targets = {}
+
+    for chat_id, msg_id in deleted:
+        for target, _, del_id in await Messages.find_message_ids(msg_id,
+                                                                 chat_id):
+            # Avoid loops between chats that forward to each other
+            if (target, del_id) in seen:
+                continue
+            seen.add((target, del_id))
+            targets.setdefault(target, []).append(del_id)
+
+    copies = []
+    for target, ids in targets.items():
+        logger.info(f"Removing {len(ids)} messages from {target}")
+        if queued:
+            await scheduler.submit(int(target), "fast", set(),
+                                   sender.delete_messages, target, ids)
+        else:
+            await sender.delete_messages(target, ids)
+        copies += [(target, id) for id in ids]
+
+    if copies:
+        await delete_copies(copies, seen, queued)
@@ -0,0 +1,267 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy
+from cv2 import (COLOR_BGR2GRAY, IMREAD_COLOR, INTER_AREA, cvtColor,
+                 imdecode, imread, resize)
+from sewar.full_ref import uqi
+
+from config import Bot
+from logger import logger
+
+# Maximum number of different bits between the hashes of two images for
+# them to be compared pixel by pixel
+MAX_DISTANCE = 10
+# Same, for the hash of a thumbnail, which is less accurate
+THUMB_DISTANCE = 16
+# Minimum UQI between two images for them to be the same image
+MIN_SIMILARITY = 0.9
+# Hashes of the blocked images that had none in the config, by path
+hashed_images = {}
+# Blocked images recently read by this process, by path, at most
+# loaded_images_size of them
+loaded_images = OrderedDict()
+loaded_images_size = 32
+
+
+def dhash(image: numpy.ndarray) -> int:
+    """Get the 64 bits difference hash of an image.
+
+    The image is shrunk to 9x8 grayscale pixels, and every bit tells if a
+    pixel is brighter than the one at its right. Resized and recompressed
+    copies of an image get the same, or a very close, hash.
+    """
+    if image.ndim == 3:
+        image = cvtColor(image, COLOR_BGR2GRAY)
+    small = resize(image, (9, 8), interpolation=INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(numpy.packbits(bits).tobytes(), "big")
+
+
+def decode(data: bytes) -> numpy.ndarray | None:
+    """Decode an image file already in memory."""
+    return imdecode(numpy.frombuffer(data, numpy.uint8), IMREAD_COLOR)
+
+
+def hamming(a: int, b: int) -> int:
+    """Get the number of different bits between two hashes."""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree of hashes, searched by Hamming distance.
+
+    Only the branches that can hold hashes within the searched distance are
+    visited, so a search doesn't look at every hash of the tree.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, hash: int, item) -> None:
+        """Add an item with the given hash."""
+        if self.root is None:
+            self.root = (hash, [item], {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (hash, [item], {})
+                return
+            node = node[2][distance]
+
+    def search(self, hash: int, max_distance: int) -> list:
+        """Get the (distance, item) pairs within `max_distance` of a hash."""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+
+        while nodes:
+            node_hash, items, children = nodes.pop()
+            distance = hamming(hash, node_hash)
+            if distance <= max_distance:
+                found += [(distance, item) for item in items]
+            # Triangle inequality, other children are too far away
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+
+        return sorted(found, key=lambda pair: pair[0])
+
+
+def image_info(path: str) -> dict | None:
+    """Get the hash and size of an image file, as stored in the config."""
+    image = imread(str(path))
+    if image is None:
+        logger.error(f"The image '{path}' could not be read")
+        return None
+
+    height, width = image.shape[:2]
+    return {"hash": f"{dhash(image):016x}", "height": height, "width": width}
+
+
+class BlockedImages:
+    """Hash index of the blocked images."""
+
+    def __init__(self, config: dict):
+        self.tree = BKTree()
+        # (path, hash) pairs of the blocked images, by (height, width)
+        self.sizes = {}
+        # Telegram IDs of the exact blocked photos
+        self.unique_ids = set()
+        hashes = config.get("blocked_image_hashes", {})
+
+        for path in config["blocked_images"]:
+            info = hashes.get(path)
+            # Images blocked by older versions have no hash yet
+            if info is None:
+                if path not in hashed_images:
+                    logger.warning(f"Hashing blocked image '{path}'")
+                    hashed_images[path] = image_info(path)
+                info = hashed_images[path]
+                if info is None:
+                    continue
+
+            if info.get("file_unique_id"):
+                self.unique_ids.add(info["file_unique_id"])
+            size = (info["height"], info["width"])
+            hash = int(info["hash"], 16)
+            self.sizes.setdefault(size, []).append((path, hash))
+            self.tree.add(hash, (path, size, hash))
+
+    def candidates(self, hash: int, height: int, width: int,
+                   max_distance: int = MAX_DISTANCE) -> list:
+        """Get the (path, hash) pairs of the blocked images of the same size
+        that look similar."""
+        if (height, width) not in self.sizes:
+            return []
+
+        return [(path, blocked_hash) for _, (path, size, blocked_hash) in
+                self.tree.search(hash, max_distance)
+                if size == (height, width)]
+
+
+def start_worker(cache_size: int) -> None:
+    """Set the number of blocked images kept by a worker process."""
+    global loaded_images_size
+    loaded_images_size = cache_size
+
+
+def load_image(path: str) -> numpy.ndarray | None:
+    """Read a blocked image, keeping the last ones read in memory.
+
+    Only the candidates of a check are read, so a worker doesn't hold every
+    blocked image in memory.
+    """
+    if path in loaded_images:
+        loaded_images.move_to_end(path)
+        return loaded_images[path]
+
+    image = imread(path)
+    loaded_images[path] = image
+    while len(loaded_images) > loaded_images_size:
+        loaded_images.popitem(last=False)
+    return image
+
+
+def find_blocked(image: str | bytes, candidates: list) -> str | None:
+    """Get the path of the blocked image that is the same as the image.
+
+    Runs in a worker process, `candidates` are the (path, hash) pairs of the
+    blocked images that could be the same. Only the ones with a hash close
+    to the one of the image are compared pixel by pixel.
+    """
+    test_img = decode(image) if isinstance(image, bytes) else imread(image)
+    if test_img is None:
+        return None
+    hash = dhash(test_img)
+
+    for path, blocked_hash in candidates:
+        if hamming(hash, blocked_hash) > MAX_DISTANCE:
+            continue
+        blocked_img = load_image(path)
+        if blocked_img is None:
+            continue
+        if uqi(test_img, blocked_img) >= MIN_SIMILARITY:
+            return path
+    return None
+
+
+class ImageChecker:
+    """Runs the image comparisons on a pool of worker processes.
+
+    The comparisons are CPU-bound, and would stop the event loop for every
+    other chat. When more than `max_pending` checks are waiting or running,
+    or a check takes more than `timeout` seconds, the image is allowed or
+    blocked as set in `on_failure`. Every worker keeps the last `cache_size`
+    blocked images it read.
+    """
+
+    def __init__(self, workers: int = 2, timeout: float = 30,
+                 max_pending: int = 16, on_failure: str = "allow",
+                 cache_size: int = 32):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.on_failure = on_failure == "block"
+        self.cache_size = cache_size
+        self.pending = 0
+        self.executor = self._start()
+
+    def _start(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.workers, initializer=start_worker,
+                                   initargs=(self.cache_size,))
+
+    def _finished(self) -> None:
+        self.pending -= 1
+
+    async def find_blocked(self, image: str | bytes,
+                           candidates: list) -> bool:
+        """Check if the image, a path or the content of the file, is one of
+        the candidate blocked images."""
+        if self.pending >= self.max_pending:
+            logger.warning("Too many images waiting to be checked, the image "
+                           f"is {'blocked' if self.on_failure else 'allowed'}")
+            return self.on_failure
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(find_blocked, image, candidates)
+            # Counted until a worker is done with it, a check that timed out
+            # keeps its worker busy
+            self.pending += 1
+            future.add_done_callback(
+                lambda _: loop.call_soon_threadsafe(self._finished))
+            path = await asyncio.wait_for(asyncio.wrap_future(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"The image check took more than {self.timeout} "
+                         "seconds")
+            return self.on_failure
+        except BrokenProcessPool:
+            logger.error("An image check worker died, restarting the pool")
+            self.executor = self._start()
+            return self.on_failure
+
+        if path is not None:
+            logger.debug(f"Image '{path}' is blocked")
+            return True
+        return False
+
+
+checker = None
+
+
+def get_checker() -> ImageChecker:
+    """Get the image checker configured in the bot.json file."""
+    global checker
+    if checker is None:
+        config = Bot().get_config().get("image_checks", {})
+        checker = ImageChecker(**config)
+    return checker
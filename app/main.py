@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import re
 import datetime
@@ -14,9 +15,14 @@ from pyrogram.errors.exceptions.bad_request_400 import (ChannelInvalid,
                                                         UsernameInvalid)
 from pyrogram.errors.exceptions.not_acceptable_406 import ChannelPrivate
 
-from forward import user
-from config import Forwarding, Bot
+from forward import replay_outbox, user
+from config import Forwarding, Bot, MessagesIDs
+from dispatch import get_scheduler
+from images import image_info
 from logger import logger
+from outbox import get_outbox
+from ratelimit import get_limiter
+from translation import get_translator
 
 # Config path
 app_dir = Path(__file__).parent
@@ -44,7 +50,7 @@ API_ID = getenv("API_ID") if getenv("API_ID") else bot_config["api_id"]
 API_HASH = getenv("API_HASH") if getenv("API_HASH") else bot_config["api_hash"]
 
 bot = Client(str(Path(config_dir/"bot")), API_ID, API_HASH)
-commands = ["start", "menu", "blockimage",
+commands = ["start", "menu", "blockimage", "stats",
             "blockall", "rmblockall", "replaceall", "rmreplaceall"]
 answer_users = {}
 
@@ -56,8 +62,7 @@ async def md5(word): return hashlib.md5(word.encode("utf-8")).hexdigest()
 async def is_admin(filter, client: Client, event: Message | CallbackQuery):
     """ Check if the user is an admin"""
     id = event.chat.id if type(event) is Message else event.message.chat.id
-    admins = Bot().get_config()["admins"]
-    return id in admins
+    return id in Bot().get_admins()
 
 
 @bot.on_message(filters.create(is_admin) & filters.command(commands))
@@ -72,6 +77,9 @@ async def on_command(client: Client, message: Message):
         else:
             await message.reply("This command can only be used in photos")
 
+    if "stats" == current_command:
+        await stats(message)
+
     if "blockall" == message.command[0]:
         await block_all(message)
     if "rmblockall" == message.command[0]:
@@ -135,6 +143,9 @@ async def on_callback_query(client: Client, callback_query: CallbackQuery):
     if data.startswith("duplicated_text_"):
         id_hash = data.split("_")[-1]
         await toggle_duplicated_text(message, id_hash)
+    if data.startswith("dedupe_"):
+        id_hash = data.split("_")[-1]
+        await toggle_dedupe(message, id_hash)
     if data.startswith("forwarding_mode_"):
         id_hash = data.split("_")[-1]
         await change_forwarding_mode(message, id_hash)
@@ -264,6 +275,8 @@ async def forwarder(message: Message, forwarder_id: str) -> None:
     reply = "🔁 Reply: on" if forwarder["reply"] else "🔁 Reply: off"
     duplicated_text = ("🔄 Duplicated text: on" if forwarder["duplicated_text"]
                        else "🔄 Duplicated text: off")
+    dedupe = ("♻️ Skip recent duplicates: on" if forwarder.get("dedupe")
+              else "♻️ Skip recent duplicates: off")
     forwarding_mode = "↪️ Forwarding mode: "
     forwarding_mode += ("copy" if forwarder["forwarding_mode"] == "copy" else
                         "forward")
@@ -281,6 +294,7 @@ async def forwarder(message: Message, forwarder_id: str) -> None:
         [{enabled: f"enabled_{forwarder_id}"}],
         [{reply: f"reply_{forwarder_id}"}],
         [{duplicated_text: f"duplicated_text_{forwarder_id}"}],
+        [{dedupe: f"dedupe_{forwarder_id}"}],
         [{forwarding_mode: f"forwarding_mode_{forwarder_id}"}],
         [{replace_words: f"replace_words_{forwarder_id}"}],
         [{blocked_words: f"blocked_words_{forwarder_id}"}],
@@ -361,6 +375,16 @@ async def toggle_duplicated_text(message: Message, forwarder_id: str):
     await forwarder(message, forwarder_id)
 
 
+async def toggle_dedupe(message: Message, forwarder_id: str):
+    """ Toggle the skipping of recent duplicates of the forwarder. """
+    # Get the forwarder
+    forwarder_dict = await forwardings.get_forwarder(forwarder_id)
+
+    forwarder_dict["dedupe"] = not forwarder_dict.get("dedupe", False)
+    await forwardings.update_forwarder(forwarder_dict)
+    await forwarder(message, forwarder_id)
+
+
 async def change_forwarding_mode(message: Message, forwarder_id: str):
     """ Change the forwarding mode of the forwarder. """
     # Get the forwarder
@@ -1075,13 +1099,56 @@ async def block_image(message: Message) -> None:
     # Download the image
     image_path = await message.download(config_dir/"blocked_img"/f"{name}.jpg")
 
-    # Add the image to blocked images
-    await forwardings.add_blocked_image(image_path)
+    # Add the image to blocked images, with its hash and Telegram ID
+    info = image_info(image_path)
+    if info is not None:
+        info["file_unique_id"] = message.photo.file_unique_id
+    await forwardings.add_blocked_image(image_path, info)
 
     # Reply
     await message.reply_text("Image blocked!")
 
 
+async def stats(message: Message) -> None:
+    """ Show the forwarding statistics. """
+    messages = MessagesIDs()
+    counters = MessagesIDs.stats
+
+    # Create the text
+    text = "**Message IDs**\n"
+    text += f"**Stored:** {messages.get_store().count()}\n"
+    text += f"**Lookups:** {counters['lookups']}\n"
+    text += f"**Misses:** {counters['misses']}\n"
+    text += f"**Evicted:** {counters['evicted']}\n"
+    text += f"**Misses by eviction:** {counters['evicted_misses']}\n"
+
+    counters = get_translator().cache.stats
+    text += "\n**Translation cache**\n"
+    text += f"**Hits:** {counters['hits']}\n"
+    text += f"**Disk hits:** {counters['disk_hits']}\n"
+    text += f"**Misses:** {counters['misses']}\n"
+
+    scheduler = get_scheduler()
+    for lane, counters in scheduler.stats.items():
+        average = counters["wait"] / counters["jobs"] if counters["jobs"]\
+            else 0
+        text += f"\n**{lane.capitalize()} lane**\n"
+        text += f"**Queued:** {scheduler.depth(lane)}\n"
+        text += f"**Sent:** {counters['jobs']}\n"
+        text += f"**Average wait:** {average:.2f}s\n"
+        text += f"**Max wait:** {counters['max_wait']:.2f}s\n"
+
+    text += f"\n**Outbox:** {get_outbox().count()} pending\n"
+
+    counters = get_limiter(user).stats
+    text += "\n**Rate limits**\n"
+    text += f"**FloodWaits:** {counters['flood_waits']}\n"
+    text += f"**Seconds waited:** {counters['flood_wait_seconds']}\n"
+
+    # Reply
+    await message.reply_text(text)
+
+
 async def block_all(message: Message) -> None:
     """ Add blocked words to all the forwarders. """
     # Get the forwarders
@@ -1209,10 +1276,14 @@ for dialog in user.get_dialogs():
     pass
 
 Bot().add_admin(user.get_me().id)  # Add user id to admin database
+# Send the messages that were not sent before the last exit
+asyncio.get_event_loop().run_until_complete(replay_outbox())
 if not Path(config_dir/"bot.session").exists():
     logger.info("Log-in with you bot token")
 bot.start()
 logger.info("Bot started")
 logger.info(f"Bot username: @{bot.get_me().username}")
 idle()
+# Write the buffered message IDs before exiting
+MessagesIDs().flush()
 bot.stop()
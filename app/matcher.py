@@ -0,0 +1,85 @@
+from collections import deque
+
+
+class BlockedWords:
+    """Aho-Corasick automaton of the blocked words of every forwarder.
+
+    All the blocked words are searched at the same time, in a single pass
+    over the text, and every match reports the forwarders that block it.
+    The search is case-insensitive, a word is blocked if it appears
+    anywhere in the text, as with `word.lower() in text.lower()`.
+    """
+
+    def __init__(self, forwarders: list):
+        # Node 0 is the root, every node has its transitions, its failure
+        # link and the targets of the forwarders that block its words
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [frozenset()]
+        # Forwarders with an empty blocked word, that blocks every message
+        # with a text or caption
+        self.always = set()
+
+        words = {}
+        for forwarder in forwarders:
+            for word in forwarder["blocked_words"]:
+                word = word.lower()
+                if not word:
+                    self.always.add(forwarder["target"])
+                    continue
+                words.setdefault(word, set()).add(forwarder["target"])
+
+        output = [set()]
+        for word, targets in words.items():
+            node = 0
+            for char in word:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    output.append(set())
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            output[node] |= targets
+
+        # Breadth-first, so the failure link of a node is always ready
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                output[child] |= output[self.fail[child]]
+
+        self.output = [frozenset(targets) for targets in output]
+
+    def search(self, texts: list, targets: set | None = None) -> set:
+        """Get the targets of the forwarders that block any of the texts.
+
+        If `targets` is given, the search stops as soon as all of them are
+        blocked.
+        """
+        # Media without a caption has no text to match the empty word
+        has_text = any(text is not None for text in texts)
+        blocked = set(self.always) if has_text else set()
+        goto, fail, output = self.goto, self.fail, self.output
+
+        for text in texts:
+            if text is None:
+                continue
+            if targets is not None and targets <= blocked:
+                break
+
+            node = 0
+            for char in text.lower():
+                while node and char not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(char, 0)
+                if output[node]:
+                    blocked |= output[node]
+                    if targets is not None and targets <= blocked:
+                        return blocked
+
+        return blocked
@@ -0,0 +1,325 @@
+import asyncio
+import os
+import shutil
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import count
+from pathlib import Path
+
+from pyrogram.types import Message
+
+from config import Bot, config_dir
+from logger import logger
+
+
+def get_scope(message: Message) -> tuple:
+    """Get the key of the media shared by the targets of a message.
+
+    The messages of a media group are forwarded together, so they share it.
+    """
+    return message.chat.id, message.media_group_id or message.id
+
+
+def get_media_key(message: Message) -> tuple:
+    """Get the key of the media of a message in its shared media.
+
+    An edit can replace the media of a message, so the key also has the
+    file_unique_id of the media.
+    """
+    media = getattr(message, message.media.value, None)\
+        if message.media else None
+    return message.id, getattr(media, "file_unique_id", None)
+
+
+def get_file_size(message: Message) -> int:
+    """Get the size of the media of a message, 0 if it's unknown."""
+    media = getattr(message, message.media.value, None)
+    return getattr(media, "file_size", None) or 0
+
+
+class MediaSpool:
+    """Downloads the media of the messages, to memory or to a spool folder.
+
+    Files up to `memory_limit` bytes are kept in memory. Bigger files are
+    downloaded to a folder inside `path`, that can be a tmpfs, and at most
+    `max_bytes` are stored there at the same time, the other downloads wait
+    for space, at most `wait_timeout` seconds. The folder is emptied when the
+    bot starts, to remove the files left by the last run.
+
+    The media of a message is downloaded once for all its targets. The
+    handler of the message holds it while it's sent to the targets, and the
+    files are deleted when the handler and every target have released it.
+    It's also uploaded once, the next targets send the file ID of the first
+    copy, so the file is deleted as soon as it's uploaded. The space of a
+    media group is reserved at once, see `reserve`.
+    """
+
+    def __init__(self, path: Path, memory_limit: int = 10485760,
+                 max_bytes: int = 2147483648, wait_timeout: float = 300):
+        # The files are stored in a folder of their own, so the spool can
+        # be emptied even if it's in a shared folder like /dev/shm
+        self.path = Path(path) / "pywardbot"
+        self.memory_limit = memory_limit
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self.used = 0
+        # Folder and size of the downloaded files, by path
+        self.files = {}
+        self.freed = asyncio.Event()
+        self.names = count()
+        # References and download tasks of the shared media, by message or
+        # media group
+        self.shared = {}
+        # Tasks that release the media of a message when its jobs are done
+        self.releasing = set()
+
+        if self.path.exists():
+            logger.info(f"Removing the files left in {self.path}")
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    async def download(self, message: Message,
+                       entry: dict | None = None) -> str | BytesIO:
+        """Download the media of the message, and get its path or buffer.
+
+        `entry` is the shared media of the message, the file takes its space
+        from the space reserved for it, if there is enough.
+        """
+        size = get_file_size(message)
+        if 0 < size <= self.memory_limit:
+            return await message.download(in_memory=True)
+
+        if entry is not None and entry["reservation"] is not None and\
+                size <= entry["reserved"]:
+            entry["reserved"] -= size
+        else:
+            await self._wait_space(size)
+            self.used += size
+
+        folder = self.path / str(next(self.names))
+        try:
+            # Downloaded to a folder, to keep the original name of the file
+            path = await message.download(f"{folder}{os.sep}")
+        except BaseException:
+            self._free(folder, size)
+            raise
+        self.files[path] = (folder, size)
+        return path
+
+    async def _wait_space(self, size: int) -> None:
+        """Wait until there is space for `size` bytes in the spool.
+
+        Raises asyncio.TimeoutError after `wait_timeout` seconds. The space
+        may only be freed by a send queued behind this one for the same
+        target, the send is tried again later from the outbox instead.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        # A file bigger than the spool waits until the spool is empty
+        while self.used and self.used + size > self.max_bytes:
+            logger.debug(f"Waiting for {size} bytes of space in the spool")
+            self.freed.clear()
+            await asyncio.wait_for(self.freed.wait(),
+                                   max(deadline - loop.time(), 0))
+
+    async def reserve(self, messages: list) -> None:
+        """Reserve the space of the media of a media group at once.
+
+        Holds the shared media of the group until it's released. A target
+        that downloads the files one after another, and waits for space in
+        the middle, could wait for the space of the files it holds. The
+        files of the group take their space from the reserved one instead,
+        and the space they didn't take is freed with the shared media.
+        """
+        self.hold(messages[0])
+        entry = self.shared[get_scope(messages[0])]
+        if entry["reservation"] is None:
+            size = sum(size for size in map(get_file_size, messages)
+                       if size > self.memory_limit)
+            entry["reservation"] = asyncio.create_task(
+                self._reserve(entry, size))
+        reservation = entry["reservation"]
+        try:
+            # Other targets may still need it if this one is cancelled
+            await asyncio.shield(reservation)
+        except BaseException:
+            # The next target tries to reserve it again
+            if reservation.done() and entry["reservation"] is reservation:
+                entry["reservation"] = None
+            self.release(messages[0])
+            raise
+
+    async def _reserve(self, entry: dict, size: int) -> None:
+        await self._wait_space(size)
+        self.used += size
+        entry["reserved"] = size
+
+    def delete(self, file: str | BytesIO) -> None:
+        """Delete a downloaded file."""
+        if isinstance(file, BytesIO):
+            file.close()
+        elif file in self.files:
+            logger.debug(f"Removing file {file}")
+            self._free(*self.files.pop(file))
+
+    def _free(self, folder: Path, size: int) -> None:
+        shutil.rmtree(folder, ignore_errors=True)
+        self.used -= size
+        self.freed.set()
+
+    def hold(self, message: Message) -> None:
+        """Keep the shared media of the message until it's released."""
+        entry = self.shared.setdefault(get_scope(message), {
+            "refs": 0, "files": {}, "file_ids": {}, "locks": {},
+            "uploaders": {}, "reservation": None, "reserved": 0})
+        entry["refs"] += 1
+
+    def release(self, message: Message) -> None:
+        """Release the shared media of the message, and delete it if nothing
+        else holds it."""
+        scope = get_scope(message)
+        entry = self.shared[scope]
+        # The upload failed, the next target uploads it
+        key = get_media_key(message)
+        if self._is_uploader(entry, key):
+            del entry["uploaders"][key]
+            entry["locks"][key].release()
+
+        entry["refs"] -= 1
+        if entry["refs"]:
+            return
+
+        del self.shared[scope]
+        if entry["reservation"] is not None:
+            entry["reservation"].cancel()
+            self.used -= entry["reserved"]
+            entry["reserved"] = 0
+            self.freed.set()
+        for task in entry["files"].values():
+            if not task.done():
+                task.cancel()
+            task.add_done_callback(self._delete_result)
+
+    @staticmethod
+    def _is_uploader(entry: dict, key: tuple) -> bool:
+        task = asyncio.current_task()
+        return task is not None and entry["uploaders"].get(key) is task
+
+    def _delete_result(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is None:
+            self.delete(task.result())
+
+    @contextmanager
+    def sharing(self, message: Message, jobs: list | None = None):
+        """Hold the shared media of the message inside the block, and until
+        the futures added to `jobs` are done."""
+        self.hold(message)
+        try:
+            yield
+        finally:
+            if jobs:
+                task = asyncio.create_task(self._release_after(message, jobs))
+                self.releasing.add(task)
+                task.add_done_callback(self.releasing.discard)
+            else:
+                self.release(message)
+
+    async def _release_after(self, message: Message, jobs: list) -> None:
+        try:
+            await asyncio.gather(*jobs, return_exceptions=True)
+        finally:
+            self.release(message)
+
+    async def acquire(self, message: Message,
+                      upload: bool = False) -> str | BytesIO:
+        """Get the shared media of the message, downloading it only once.
+
+        Must be released with `release`. If it's being downloaded, waits for
+        that download instead of starting another one.
+
+        If `upload` is True, the file ID of an uploaded copy is returned if
+        there is one. Otherwise, the next targets wait until this one calls
+        `uploaded` or `release`, to send the file ID instead of uploading the
+        file again.
+        """
+        self.hold(message)
+        entry = self.shared[get_scope(message)]
+        key = get_media_key(message)
+        if upload:
+            try:
+                file_id = await self._wait_upload(entry, key)
+            except asyncio.CancelledError:
+                self.release(message)
+                raise
+            if file_id is not None:
+                return file_id
+
+        files = entry["files"]
+        if key not in files:
+            files[key] = asyncio.create_task(
+                self.download(message, entry))
+        task = files[key]
+
+        try:
+            # Other targets may still need it if this one is cancelled
+            file = await asyncio.shield(task)
+        except Exception:
+            # The next target tries to download it again
+            if files.get(key) is task:
+                del files[key]
+            self.release(message)
+            raise
+        except asyncio.CancelledError:
+            self.release(message)
+            raise
+
+        # Every target reads its own copy of the buffer
+        if isinstance(file, BytesIO):
+            copy = BytesIO(file.getvalue())
+            copy.name = file.name
+            return copy
+        return file
+
+    async def _wait_upload(self, entry: dict, key: tuple) -> str | None:
+        """Get the file ID of an uploaded copy, or lock the upload."""
+        if key in entry["file_ids"]:
+            return entry["file_ids"][key]
+
+        lock = entry["locks"].setdefault(key, asyncio.Lock())
+        await lock.acquire()
+        if key in entry["file_ids"]:
+            lock.release()
+            return entry["file_ids"][key]
+        entry["uploaders"][key] = asyncio.current_task()
+        return None
+
+    def uploaded(self, message: Message, file_id: str) -> None:
+        """Save the file ID of the uploaded copy of the shared media."""
+        entry = self.shared.get(get_scope(message))
+        if entry is None:
+            return
+        key = get_media_key(message)
+        entry["file_ids"][key] = file_id
+        if self._is_uploader(entry, key):
+            del entry["uploaders"][key]
+            entry["locks"][key].release()
+
+        # The next targets send the file ID, the file is no longer needed
+        task = entry["files"].pop(key, None)
+        if task is not None:
+            task.add_done_callback(self._delete_result)
+
+
+spool = None
+
+
+def get_spool() -> MediaSpool:
+    """Get the media spool configured in the bot.json file."""
+    global spool
+    if spool is None:
+        config = Bot().get_config().get("media", {})
+        path = config.get("spool_dir") or config_dir/"spool"
+        spool = MediaSpool(path, config.get("memory_limit", 10485760),
+                           config.get("spool_max_bytes", 2147483648),
+                           config.get("spool_wait_timeout", 300))
+    return spool
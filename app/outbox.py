@@ -0,0 +1,113 @@
+import asyncio
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from pyrogram.errors import FloodWait, InternalServerError
+
+from config import Bot, config_dir
+from logger import logger
+
+# Errors after which a delivery is tried again
+TRANSIENT_ERRORS = (FloodWait, InternalServerError, OSError,
+                    asyncio.TimeoutError)
+
+
+class Outbox:
+    """Deliveries of messages to targets, kept in a SQLite database.
+
+    Every delivery is written before it's sent, and deleted once it's done,
+    so the deliveries interrupted by a restart are still in the outbox and
+    are sent again. A delivery that fails with a transient error is tried
+    again after `retry_delay` seconds, doubled on every attempt up to
+    `max_retry_delay`, and given up after `max_attempts` attempts.
+    """
+
+    def __init__(self, path: Path, max_attempts: int = 8,
+                 retry_delay: float = 5, max_retry_delay: float = 900):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                "id INTEGER PRIMARY KEY, "
+                "source INTEGER NOT NULL, "
+                "message_id INTEGER NOT NULL, "
+                "target INTEGER NOT NULL, "
+                "mode TEXT NOT NULL, "
+                "flags TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt REAL NOT NULL DEFAULT 0, "
+                "error TEXT)")
+
+    def add(self, source: int, message_id: int, target: int, mode: str,
+            flags: dict) -> int:
+        """Add a delivery, and get its ID."""
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO deliveries (source, message_id, target, mode, "
+                "flags) VALUES (?, ?, ?, ?, ?)",
+                (source, message_id, target, mode, json.dumps(flags)))
+        return cursor.lastrowid
+
+    def done(self, delivery: int) -> None:
+        """Remove a delivery that was sent, or can't be sent."""
+        with self.db:
+            self.db.execute("DELETE FROM deliveries WHERE id = ?",
+                            (delivery,))
+
+    def failed(self, delivery: int, error: Exception) -> float | None:
+        """Record a failed attempt, and get the seconds until the next one.
+
+        Returns None if the delivery was given up.
+        """
+        row = self.db.execute(
+            "SELECT attempts FROM deliveries WHERE id = ?",
+            (delivery,)).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Giving up delivery {delivery} after {attempts} "
+                         "attempts")
+            self.done(delivery)
+            return None
+
+        delay = min(self.retry_delay * 2 ** (attempts - 1),
+                    self.max_retry_delay)
+        with self.db:
+            self.db.execute(
+                "UPDATE deliveries SET attempts = ?, next_attempt = ?, "
+                "error = ? WHERE id = ?",
+                (attempts, time.time() + delay,
+                 f"{type(error).__name__}: {error}", delivery))
+        return delay
+
+    def pending(self) -> list:
+        """Get the (id, source, message_id, target, mode, flags, delay)
+        rows of the deliveries that were not sent."""
+        now = time.time()
+        return [(*row[:5], json.loads(row[5]), max(0, row[6] - now))
+                for row in self.db.execute(
+                    "SELECT id, source, message_id, target, mode, flags, "
+                    "next_attempt FROM deliveries ORDER BY id")]
+
+    def count(self) -> int:
+        """Get the number of deliveries that were not sent."""
+        return self.db.execute("SELECT COUNT(*) FROM deliveries").fetchone()[0]
+
+
+outbox = None
+
+
+def get_outbox() -> Outbox:
+    """Get the outbox configured in the bot.json file."""
+    global outbox
+    if outbox is None:
+        config = Bot().get_config().get("outbox", {})
+        outbox = Outbox(config_dir/"outbox.db", **config)
+    return outbox
@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from pyrogram import Client
+from pyrogram.enums import ChatType
+from pyrogram.errors import FloodWait
+
+from config import Bot
+from logger import logger
+
+# Methods of the client, besides send_* and edit_*, that change a chat
+LIMITED_METHODS = ("forward_messages", "delete_messages", "pin_chat_message")
+
+
+class TokenBucket:
+    """Allows `rate` calls per second, with bursts of up to `burst` calls.
+
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        # The callers get their tokens in order
+        self.lock = asyncio.Lock()
+
+    async def take(self) -> None:
+        """Wait until a call is allowed."""
+        if not self.rate:
+            return
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Allow no calls for the given number of seconds."""
+        self.paused_until = max(self.paused_until,
+                                time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class RateLimiter:
+    """Proxy of the client that paces the calls that send to a chat.
+
+    The send_*, edit_* and LIMITED_METHODS methods take a token from the
+    bucket of the chat, whose rate depends on the type of the chat unless
+    it's set in `targets`, and from the bucket of the account. If Telegram
+    answers with a FloodWait, the bucket of the chat is paused for the
+    given time, and the call is retried up to `max_retries` times.
+    """
+
+    def __init__(self, client: Client, account: dict | None = None,
+                 private: dict | None = None, group: dict | None = None,
+                 channel: dict | None = None, targets: dict | None = None,
+                 max_retries: int = 5):
+        self.client = client
+        self.account = TokenBucket(**(account or {"rate": 20, "burst": 30}))
+        self.defaults = {
+            "private": private or {"rate": 1, "burst": 3},
+            "group": group or {"rate": 0.33, "burst": 5},
+            "channel": channel or {"rate": 0.33, "burst": 5}}
+        self.targets = targets or {}
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.stats = {"flood_waits": 0, "flood_wait_seconds": 0}
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+        if not name.startswith(("send_", "edit_")) and\
+                name not in LIMITED_METHODS:
+            return method
+
+        async def call(chat_id, *args, **kwargs):
+            return await self.call(chat_id, method, chat_id, *args, **kwargs)
+        return call
+
+    async def get_bucket(self, chat_id: int | str) -> TokenBucket:
+        """Get the bucket of a chat, its type is only resolved once."""
+        key = str(chat_id)
+        if key in self.buckets:
+            return self.buckets[key]
+
+        limits = self.targets.get(key)
+        if limits is None:
+            try:
+                chat = await self.client.get_chat(chat_id)
+                if chat.type is ChatType.CHANNEL:
+                    kind = "channel"
+                elif chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+                    kind = "group"
+                else:
+                    kind = "private"
+            except Exception as e:
+                logger.error(f"The type of the chat {chat_id} could not be "
+                             f"resolved, limiting it as a group: {e}")
+                kind = "group"
+            limits = self.defaults[kind]
+
+        # Another call may have created it while the chat was resolved
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(**limits)
+        return self.buckets[key]
+
+    async def call(self, chat_id: int | str, method, *args, **kwargs):
+        """Call a method of the client when the buckets allow it."""
+        bucket = await self.get_bucket(chat_id)
+
+        for attempt in range(self.max_retries + 1):
+            await bucket.take()
+            await self.account.take()
+            try:
+                return await method(*args, **kwargs)
+            except FloodWait as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["flood_waits"] += 1
+                self.stats["flood_wait_seconds"] += e.value
+                logger.warning(f"FloodWait of {e.value} seconds in "
+                               f"{chat_id}, retrying after it")
+                bucket.pause(e.value)
+
+
+limiter = None
+
+
+def get_limiter(client: Client) -> RateLimiter:
+    """Get the rate limiter configured in the bot.json file."""
+    global limiter
+    if limiter is None:
+        config = Bot().get_config().get("rate_limits", {})
+        limiter = RateLimiter(client, **config)
+    return limiter
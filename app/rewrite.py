@@ -0,0 +1,238 @@
+import re
+
+from logger import logger
+
+# Symbols that can start or end a word in the word boundary match mode
+SYMBOLS = ("@", "#", "$")
+# Characters that make a word a regular expression instead of a literal
+SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+
+def trie_regex(words: list) -> str:
+    """Build a regex that matches any of the words, factored as a trie.
+
+    Python's re module tries every branch of an alternation one by one, a
+    trie shares the common prefixes so each position is checked once.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+
+        regex = branches[0] if len(branches) == 1 else\
+            "(?:" + "|".join(branches) + ")"
+        # The word can also end here
+        if "" in node:
+            regex = "(?:" + regex + ")?"
+        return regex
+
+    return build(trie)
+
+
+def word_pattern(word: str, mode: str) -> str:
+    """Get the regex used to replace a single word."""
+    if mode != "word_boundary_match":
+        return word
+
+    # If the word starts with
+    if word[0] in SYMBOLS:
+        return r"[%s]\b%s\b" % (word[0], word[1:])
+    # If the word ends with
+    elif word[-1] in SYMBOLS:
+        return r"\b%s[%s]" % (word[:-1], word[-1])
+    return r"\b%s\b" % word
+
+
+class Run:
+    """Consecutive literal words that can be replaced in a single pass."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.lookup = {}
+        self.words = {"plain": [], "prefixed": [], "suffixed": []}
+        self.keys = set()
+        self.substrings = set()
+        self.prefixes = set()
+        self.suffixes = set()
+        self.values = []
+
+    def conflicts(self, key: str, kind: str) -> bool:
+        """Check if the result would depend on the order of the words.
+
+        That happens when the word, with its symbol, contains, is contained
+        in or partially overlaps a word of the run, or when a previous
+        replacement could create it, alone or joined with the text around
+        it, or could change a word boundary next to it.
+        """
+        if key in self.substrings:
+            return True
+        for i in range(len(key)):
+            for j in range(i + 1, len(key) + 1):
+                if key[i:j] in self.keys:
+                    return True
+        for i in range(1, len(key)):
+            if key[i:] in self.prefixes or key[:i] in self.suffixes:
+                return True
+        return any(self.creates(value, value_kind, key) or
+                   self.changes_boundary(value, value_kind, kind)
+                   for value, value_kind in self.values)
+
+    def creates(self, value: str, value_kind: str, key: str) -> bool:
+        """Check if a replacement could create the word in the text.
+
+        The word can be inside the replacement, or contain it, start or end
+        inside it and go on with the text around it. An empty replacement
+        joins the text before and after it. In the word boundary match mode,
+        the text around a replaced word is a non-word character, unless the
+        word has a symbol on that side.
+        """
+        boundary = self.mode == "word_boundary_match"
+        # Every position of the replacement that overlaps the word
+        for offset in range(1 - len(value) if value else 1, len(key)):
+            end = offset + len(value)
+            if key[max(offset, 0):end] != value[max(-offset, 0):
+                                                len(key) - offset]:
+                continue
+            if boundary and offset > 0 and value_kind != "prefixed" and\
+                    re.match(r"\w", key[offset - 1]):
+                continue
+            if boundary and end < len(key) and value_kind != "suffixed" and\
+                    re.match(r"\w", key[end]):
+                continue
+            return True
+        return False
+
+    def changes_boundary(self, value: str, value_kind: str,
+                         kind: str) -> bool:
+        """Check if a replacement could change the word boundary of a word
+        next to it.
+
+        A word that starts or ends with a symbol can be next to another
+        word, the boundary between them is lost if the symbol is replaced
+        with a word character, or removed.
+        """
+        if self.mode != "word_boundary_match":
+            return False
+        if value_kind == "prefixed" and kind != "suffixed":
+            return not value or re.match(r"\w", value[0]) is not None
+        if value_kind == "suffixed" and kind != "prefixed":
+            return not value or re.match(r"\w", value[-1]) is not None
+        return False
+
+    def add(self, key: str, value: str, kind: str) -> None:
+        """Add a word to the run."""
+        self.lookup[key] = value
+        self.words[kind].append(key)
+        self.keys.add(key)
+        for i in range(len(key)):
+            self.prefixes.add(key[:i + 1])
+            self.suffixes.add(key[i:])
+            for j in range(i + 1, len(key) + 1):
+                self.substrings.add(key[i:j])
+        self.values.append((value.lower(), kind))
+
+
+class Rewriter:
+    """Compiled replace_words, replace_words_mode and patterns of a forwarder.
+
+    The words are replaced in their original order, but consecutive literal
+    words that can't affect each other are joined in a single regex, and
+    replaced in one pass over the text with a lookup of the replacement of
+    each match. Words that are regular expressions, or whose replacement has
+    group references, are applied one by one.
+    """
+
+    def __init__(self, forwarder: dict):
+        mode = forwarder["replace_words_mode"]
+        # List of (regex, replacement) passes, the replacement is either a
+        # string or a lookup callback
+        self.passes = []
+        run = Run(mode)
+
+        for word, value in forwarder["replace_words"].items():
+            if not word:
+                continue
+
+            core, kind = word, "plain"
+            if mode == "word_boundary_match":
+                if word[0] in SYMBOLS:
+                    core, kind = word[1:], "prefixed"
+                elif word[-1] in SYMBOLS:
+                    core, kind = word[:-1], "suffixed"
+
+            # The boundaries must be between a symbol or space and a word
+            # character, for the joined regex to match the same text
+            literal = core and not SPECIAL.search(core) and "\\" not in value
+            if mode == "word_boundary_match":
+                literal = literal and re.match(r"\w", core[0]) and\
+                    re.match(r"\w", core[-1])
+
+            if not literal:
+                self._join(run, mode)
+                run = Run(mode)
+                pattern = re.compile(word_pattern(word, mode), re.I)
+                self.passes.append((pattern, value))
+                continue
+
+            # If the word overlaps with a word of the run, or one of its
+            # replacements could create it, the order matters
+            key = word.lower()
+            if run.conflicts(key, kind):
+                self._join(run, mode)
+                run = Run(mode)
+            run.add(key, value, kind)
+        self._join(run, mode)
+
+        self.patterns = [(pattern["name"],
+                          re.compile(pattern["pattern"], re.DOTALL),
+                          pattern["group"])
+                         for pattern in forwarder["patterns"]]
+
+    def _join(self, run: Run, mode: str) -> None:
+        """Add a pass that replaces all the words of the run at once."""
+        if not run.lookup:
+            return
+
+        lookup = run.lookup
+        words = run.words
+
+        if mode == "word_boundary_match":
+            branches = []
+            if words["plain"]:
+                branches.append(r"\b%s\b" % trie_regex(words["plain"]))
+            if words["prefixed"]:
+                branches.append(r"%s\b" % trie_regex(words["prefixed"]))
+            if words["suffixed"]:
+                branches.append(r"\b%s" % trie_regex(words["suffixed"]))
+            regex = "|".join(branches)
+        else:
+            regex = trie_regex(words["plain"])
+
+        def replacement(match: re.Match) -> str:
+            found = match.group(0)
+            return lookup.get(found.lower(), found)
+
+        self.passes.append((re.compile(regex, re.I), replacement))
+
+    def replace(self, text: str) -> str:
+        """Replace the words of the forwarder in the text."""
+        for pattern, replacement in self.passes:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def select(self, text: str) -> str:
+        """Select the text of the first pattern that matches."""
+        for name, pattern, group in self.patterns:
+            match = pattern.search(text)
+            if match:
+                logger.debug(f"Pattern '{name}' found in text")
+                return match.group(group)
+        return text
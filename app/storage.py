@@ -0,0 +1,374 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from logger import logger
+
+
+class MessageStore:
+    """Base class of the message ID map backends.
+
+    The map stores, for every target chat, the ID of the copy of each
+    message of a source chat.
+    """
+
+    def get(self, target: int, source: int, real_id: int) -> int | None:
+        """Get the ID of the copy of a source message in the target."""
+        raise NotImplementedError
+
+    def find(self, real_id: int, source: int | None = None) -> list:
+        """Get the (target, source, copy_id) rows of a source message.
+
+        If `source` is None, the message is looked up in every source chat.
+        """
+        raise NotImplementedError
+
+    def add_many(self, rows: list) -> None:
+        """Add (target, source, real_id, copy_id) rows to the map."""
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """Get the number of messages in the map."""
+        raise NotImplementedError
+
+    def touch_many(self, keys: list) -> None:
+        """Mark the (target, source, real_id) keys as recently used."""
+
+    def prune(self, retention: dict, limit: int) -> int:
+        """Delete up to `limit` messages out of the retention policy.
+
+        Returns the number of deleted messages.
+        """
+        return 0
+
+    def was_evicted(self, target: int, source: int, real_id: int) -> bool:
+        """Check if a missing message was deleted by the retention policy."""
+        return False
+
+    def close(self) -> None:
+        """Release the resources used by the backend."""
+
+
+def target_rules(retention: dict, target: int) -> dict:
+    """Get the retention rules that apply to a target chat."""
+    rules = {key: value for key, value in retention.items()
+             if key != "targets"}
+    rules.update(retention.get("targets", {}).get(str(target), {}))
+    return rules
+
+
+class JSONMessageStore(MessageStore):
+    """Message ID map kept in a JSON file.
+
+    The whole file is rewritten on every change, this backend is only
+    meant for small deployments and for compatibility.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+        if not os.path.exists(path):
+            logger.warning(f"{path.name} not found")
+            self.messages_ids = {}
+            self._save()
+        else:
+            with open(path, "r") as f:
+                self.messages_ids = json.load(f)
+
+        # Reverse index, source message ID -> {(target, source)}
+        self.real_ids = {}
+        for target, sources in self.messages_ids.items():
+            for source, ids in sources.items():
+                for real_id in ids:
+                    self.real_ids.setdefault(real_id, set()).add(
+                        (target, source))
+
+    def _save(self) -> None:
+        with open(self.path, "w") as f:
+            json.dump(self.messages_ids, f, indent=4, ensure_ascii=False)
+
+    def get(self, target: int, source: int, real_id: int) -> int | None:
+        return self.messages_ids.get(str(target), {}).get(
+            str(source), {}).get(str(real_id))
+
+    def find(self, real_id: int, source: int | None = None) -> list:
+        rows = []
+        for target, chat in self.real_ids.get(str(real_id), ()):
+            if source is not None and chat != str(source):
+                continue
+            copy_id = self.messages_ids[target][chat][str(real_id)]
+            rows.append((int(target), int(chat), copy_id))
+        return rows
+
+    def add_many(self, rows: list) -> None:
+        for target, source, real_id, copy_id in rows:
+            self.messages_ids.setdefault(str(target), {}).setdefault(
+                str(source), {})[str(real_id)] = copy_id
+            self.real_ids.setdefault(str(real_id), set()).add(
+                (str(target), str(source)))
+        self._save()
+
+    def count(self) -> int:
+        return sum(len(ids) for sources in self.messages_ids.values()
+                   for ids in sources.values())
+
+    def prune(self, retention: dict, limit: int) -> int:
+        # The JSON map has no timestamps, only max_entries is supported
+        deleted = 0
+        for target, sources in self.messages_ids.items():
+            max_entries = target_rules(retention, target).get("max_entries")
+            if not max_entries or deleted >= limit:
+                continue
+            for source, ids in sources.items():
+                excess = len(ids) - max_entries
+                if excess <= 0:
+                    continue
+                for real_id in sorted(ids, key=int)[:min(excess,
+                                                         limit - deleted)]:
+                    del ids[real_id]
+                    self.real_ids[real_id].discard((target, source))
+                    if not self.real_ids[real_id]:
+                        del self.real_ids[real_id]
+                    deleted += 1
+                if deleted >= limit:
+                    break
+
+        if deleted:
+            self._save()
+        return deleted
+
+
+class SQLiteMessageStore(MessageStore):
+    """Message ID map kept in a SQLite database."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "target INTEGER NOT NULL, "
+                "source INTEGER NOT NULL, "
+                "real_id INTEGER NOT NULL, "
+                "copy_id INTEGER NOT NULL, "
+                "PRIMARY KEY (target, source, real_id)) WITHOUT ROWID")
+            # Reverse index used to find the copies of a deleted message,
+            # with or without its source chat
+            self.db.execute("DROP INDEX IF EXISTS messages_source")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_real_id "
+                "ON messages (real_id, source)")
+
+            # Timestamps used by the retention policy, the messages of older
+            # databases are considered new
+            columns = [row[1] for row in
+                       self.db.execute("PRAGMA table_info(messages)")]
+            for column in ("created_at", "accessed_at"):
+                if column not in columns:
+                    self.db.execute(
+                        f"ALTER TABLE messages ADD COLUMN {column} "
+                        "INTEGER NOT NULL DEFAULT 0")
+                    self.db.execute(f"UPDATE messages SET {column} = ?",
+                                    (int(time.time()),))
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_created "
+                "ON messages (created_at)")
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_accessed "
+                "ON messages (accessed_at)")
+
+            # Highest source message ID deleted by the retention policy
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS evicted ("
+                "target INTEGER NOT NULL, "
+                "source INTEGER NOT NULL, "
+                "real_id INTEGER NOT NULL, "
+                "PRIMARY KEY (target, source)) WITHOUT ROWID")
+
+    def get(self, target: int, source: int, real_id: int) -> int | None:
+        row = self.db.execute(
+            "SELECT copy_id FROM messages "
+            "WHERE target = ? AND source = ? AND real_id = ?",
+            (target, source, real_id)).fetchone()
+        return row[0] if row else None
+
+    def find(self, real_id: int, source: int | None = None) -> list:
+        if source is None:
+            return self.db.execute(
+                "SELECT target, source, copy_id FROM messages "
+                "WHERE real_id = ?", (real_id,)).fetchall()
+        return self.db.execute(
+            "SELECT target, source, copy_id FROM messages "
+            "WHERE real_id = ? AND source = ?", (real_id, source)).fetchall()
+
+    def add_many(self, rows: list) -> None:
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages "
+                "(target, source, real_id, copy_id, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(*row, now, now) for row in rows])
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def touch_many(self, keys: list) -> None:
+        now = int(time.time())
+        with self.db:
+            self.db.executemany(
+                "UPDATE messages SET accessed_at = ? "
+                "WHERE target = ? AND source = ? AND real_id = ?",
+                [(now, *key) for key in keys])
+
+    def prune(self, retention: dict, limit: int) -> int:
+        deleted = 0
+        now = int(time.time())
+        overridden = [int(target) for target in retention.get("targets", {})]
+
+        # Messages older than max_age_days, global rule first
+        max_age = retention.get("max_age_days")
+        if max_age:
+            deleted += self._evict(self.db.execute(
+                "SELECT target, source, real_id FROM messages "
+                "WHERE created_at < ? AND target NOT IN "
+                f"({', '.join('?' * len(overridden))}) LIMIT ?",
+                (now - max_age * 86400, *overridden, limit)).fetchall())
+        for target in overridden:
+            max_age = target_rules(retention, target).get("max_age_days")
+            if max_age and deleted < limit:
+                deleted += self._evict(self.db.execute(
+                    "SELECT target, source, real_id FROM messages "
+                    "WHERE target = ? AND created_at < ? LIMIT ?",
+                    (target, now - max_age * 86400,
+                     limit - deleted)).fetchall())
+
+        # Oldest messages above max_entries per (target, source)
+        if retention.get("max_entries") or overridden:
+            groups = self.db.execute(
+                "SELECT target, source, COUNT(*) FROM messages "
+                "GROUP BY target, source").fetchall()
+            for target, source, count in groups:
+                max_entries = target_rules(retention, target).get(
+                    "max_entries")
+                if not max_entries or count <= max_entries:
+                    continue
+                if deleted >= limit:
+                    break
+                deleted += self._evict(self.db.execute(
+                    "SELECT target, source, real_id FROM messages "
+                    "WHERE target = ? AND source = ? ORDER BY real_id "
+                    "LIMIT ?", (target, source,
+                                min(count - max_entries,
+                                    limit - deleted))).fetchall())
+
+        # Least recently used messages above max_total
+        max_total = retention.get("max_total")
+        if max_total and deleted < limit:
+            excess = self.count() - max_total
+            if excess > 0:
+                deleted += self._evict(self.db.execute(
+                    "SELECT target, source, real_id FROM messages "
+                    "ORDER BY accessed_at LIMIT ?",
+                    (min(excess, limit - deleted),)).fetchall())
+
+        return deleted
+
+    def _evict(self, keys: list) -> int:
+        """Delete the given keys and remember the evicted message IDs."""
+        if not keys:
+            return 0
+
+        watermarks = {}
+        for target, source, real_id in keys:
+            if real_id > watermarks.get((target, source), 0):
+                watermarks[(target, source)] = real_id
+
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM messages "
+                "WHERE target = ? AND source = ? AND real_id = ?", keys)
+            self.db.executemany(
+                "INSERT INTO evicted (target, source, real_id) "
+                "VALUES (?, ?, ?) ON CONFLICT (target, source) "
+                "DO UPDATE SET real_id = MAX(real_id, excluded.real_id)",
+                [(*key, real_id) for key, real_id in watermarks.items()])
+        return len(keys)
+
+    def was_evicted(self, target: int, source: int, real_id: int) -> bool:
+        # Message IDs grow over time, so anything at or below the highest
+        # evicted ID of the chat is assumed to have been evicted
+        row = self.db.execute(
+            "SELECT real_id FROM evicted WHERE target = ? AND source = ?",
+            (target, source)).fetchone()
+        return row is not None and real_id <= row[0]
+
+    def import_json(self, path: Path) -> None:
+        """Import the message IDs of a messages.json file, once."""
+        with open(path, "r") as f:
+            messages_ids = json.load(f)
+
+        rows = [(int(target), int(source), int(real_id), copy_id)
+                for target, sources in messages_ids.items()
+                for source, ids in sources.items()
+                for real_id, copy_id in ids.items()]
+        self.add_many(rows)
+
+        # Keep the old file around, but don't import it again
+        os.replace(path, path.with_suffix(".json.migrated"))
+        logger.info(f"Migrated {len(rows)} message IDs from {path.name}")
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class LastTexts:
+    """Fingerprint of the text of the last message sent to each target.
+
+    Kept in memory, and in a SQLite database if `path` is given, so it
+    survives restarts.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.fingerprints = {}
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS last_texts ("
+                    "target INTEGER PRIMARY KEY, "
+                    "fingerprint TEXT NOT NULL)")
+            self.fingerprints = dict(self.db.execute(
+                "SELECT target, fingerprint FROM last_texts"))
+
+    @staticmethod
+    def fingerprint(text: str | None) -> str:
+        """Get the fingerprint of a text, empty for messages without text."""
+        if not text:
+            return ""
+        return hashlib.sha1(text.strip().encode("utf-8")).hexdigest()
+
+    def get(self, target: int) -> str | None:
+        """Get the fingerprint of the last text, None if it's unknown."""
+        return self.fingerprints.get(int(target))
+
+    def set(self, target: int, text: str | None) -> None:
+        """Save the text of the last message sent to a target."""
+        fingerprint = self.fingerprint(text)
+        if self.fingerprints.get(int(target)) == fingerprint:
+            return
+
+        self.fingerprints[int(target)] = fingerprint
+        if self.db is not None:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO last_texts (target, fingerprint) "
+                    "VALUES (?, ?)", (int(target), fingerprint))
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import sqlite3
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from deep_translator import GoogleTranslator
+
+from config import Bot, config_dir
+from logger import logger
+
+
+class TranslatorBackend:
+    """Base class of the translation backends."""
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        """Translate the text from the source to the target language."""
+        raise NotImplementedError
+
+
+class GoogleBackend(TranslatorBackend):
+    """Google Translate, through deep_translator.
+
+    deep_translator is blocking, so the requests are run on a bounded
+    thread pool instead of the event loop.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="translate")
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, GoogleTranslator(source, target).translate, text)
+
+
+class StubBackend(TranslatorBackend):
+    """Offline backend that returns the text as is, after an optional delay.
+
+    Used to benchmark the forwarding without network access.
+    """
+
+    def __init__(self, workers: int = 4, delay: float = 0):
+        self.delay = delay
+
+    async def translate(self, text: str, source: str, target: str) -> str:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return text
+
+
+backends = {"google": GoogleBackend, "stub": StubBackend}
+
+
+class TranslationCache:
+    """LRU cache of translations, with an optional SQLite tier.
+
+    The translations are keyed by the hash of the normalized text and the
+    languages, the SQLite tier keeps them across restarts.
+    """
+
+    def __init__(self, size: int = 1000, path: Path | None = None,
+                 disk_size: int = 100000):
+        self.size = size
+        self.disk_size = disk_size
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            with self.db:
+                self.db.execute(
+                    "CREATE TABLE IF NOT EXISTS translations ("
+                    "key TEXT PRIMARY KEY, "
+                    "translation TEXT NOT NULL, "
+                    "created_at INTEGER NOT NULL)")
+                self.db.execute(
+                    "CREATE INDEX IF NOT EXISTS translations_created "
+                    "ON translations (created_at)")
+            self.inserts = 0
+
+    @staticmethod
+    def key(text: str, source: str, target: str) -> str:
+        """Get the cache key of a translation."""
+        text = unicodedata.normalize("NFC", text).strip()
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{digest}:{source}:{target}"
+
+    def get(self, key: str) -> str | None:
+        """Get a cached translation."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.entries[key]
+
+        if self.db is not None:
+            row = self.db.execute(
+                "SELECT translation FROM translations WHERE key = ?",
+                (key,)).fetchone()
+            if row:
+                self.stats["disk_hits"] += 1
+                self._remember(key, row[0])
+                return row[0]
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key: str, translation: str) -> None:
+        """Cache a translation."""
+        self._remember(key, translation)
+
+        if self.db is not None:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO translations "
+                    "(key, translation, created_at) VALUES (?, ?, ?)",
+                    (key, translation, int(time.time())))
+                # Keep the disk tier bounded, checked every 100 inserts
+                self.inserts += 1
+                if self.inserts % 100 == 0:
+                    self.db.execute(
+                        "DELETE FROM translations WHERE key IN ("
+                        "SELECT key FROM translations "
+                        "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                        (self.disk_size,))
+
+    def _remember(self, key: str, translation: str) -> None:
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Translator:
+    """Runs the translations of a backend with bounded concurrency.
+
+    At most `concurrency` translations are in flight at the same time, and
+    each one is given up after `timeout` seconds.
+    """
+
+    def __init__(self, backend: TranslatorBackend, concurrency: int = 4,
+                 timeout: float = 10, cache: TranslationCache | None = None):
+        self.backend = backend
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.cache = cache if cache is not None else TranslationCache(0)
+
+    async def translate(self, text: str, source: str,
+                        target: str) -> str | None:
+        """Translate the text, or return None if the translation failed."""
+        key = self.cache.key(text, source, target)
+        translation = self.cache.get(key)
+        if translation is not None:
+            return translation
+
+        async with self.semaphore:
+            try:
+                translation = await asyncio.wait_for(
+                    self.backend.translate(text, source, target),
+                    self.timeout)
+                if translation:
+                    self.cache.set(key, translation)
+                return translation
+            except asyncio.TimeoutError:
+                logger.error(f"The translation took more than {self.timeout}"
+                             " seconds, sending the original text")
+            except Exception as e:
+                logger.error(f"The text could not be translated: {e}")
+        return None
+
+
+translator = None
+
+
+def get_translator() -> Translator:
+    """Get the translator configured in the bot.json file."""
+    global translator
+    if translator is not None:
+        return translator
+
+    config = Bot().get_config().get("translation", {})
+    name = config.get("backend", "google")
+    concurrency = config.get("concurrency", 4)
+    if name not in backends:
+        logger.error(f"Unknown translation backend '{name}', using google")
+        name = "google"
+
+    backend = backends[name](concurrency, **config.get("options", {}))
+    cache_file = config.get("cache_file")
+    cache = TranslationCache(config.get("cache_size", 1000),
+                             config_dir/cache_file if cache_file else None,
+                             config.get("cache_disk_size", 100000))
+    translator = Translator(backend, concurrency, config.get("timeout", 10),
+                            cache)
+    return translator
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+
+pytest.importorskip("pyrogram")
+
+from dispatch import Scheduler  # noqa: E402
+from media import MediaSpool  # noqa: E402
+
+
+class Video:
+    """Message with a video of a protected chat."""
+
+    media = SimpleNamespace(value="video")
+
+    def __init__(self, id: int, size: int):
+        self.id = id
+        self.chat = SimpleNamespace(id=-100, has_protected_content=True)
+        self.media_group_id = None
+        self.video = SimpleNamespace(file_size=size,
+                                     file_unique_id=f"unique{id}")
+
+    async def download(self, file_name: str = "", in_memory: bool = False):
+        await asyncio.sleep(0.01)
+        os.makedirs(file_name, exist_ok=True)
+        path = os.path.join(file_name, "video.mp4")
+        with open(path, "w") as f:
+            f.write("video")
+        return path
+
+
+async def send_copy(spool: MediaSpool, message: Video, sent: list):
+    """Upload the video once, or send the file ID of the first upload."""
+    try:
+        file = await spool.acquire(message, upload=True)
+        await asyncio.sleep(0.01)
+        sent.append(file)
+        spool.uploaded(message, f"file_id{message.id}")
+    finally:
+        spool.release(message)
+
+
+async def fan_out(spool: MediaSpool, message: Video, targets: list):
+    scheduler = Scheduler(workers=4, bulk_workers=2)
+    sent = []
+    jobs = []
+    with spool.sharing(message, jobs):
+        for target in targets:
+            jobs.append(await scheduler.submit(
+                target, "bulk", {message.id}, send_copy, spool, message,
+                sent))
+    await asyncio.gather(*jobs)
+    # The handler's hold is released after the jobs
+    await asyncio.sleep(0.05)
+    return sent
+
+
+def test_fan_out_releases_the_media(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, memory_limit=0, max_bytes=100 << 20)
+        sent = await fan_out(spool, Video(1, 50 << 20), [1, 2])
+        assert sent[0].endswith("video.mp4") and sent[1] == "file_id1"
+        assert spool.shared == {}
+        assert spool.used == 0
+
+        # A message without media, or without targets
+        await fan_out(spool, Video(2, 0), [])
+        assert spool.shared == {}
+        assert spool.used == 0
+    asyncio.run(main())
+
+
+def test_edited_media_is_not_reused(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, memory_limit=0, max_bytes=100 << 20)
+        message = Video(1, 10)
+        edited = Video(1, 10)
+        edited.video.file_unique_id = "edited"
+
+        # The original is still held while the edit is sent
+        with spool.sharing(message):
+            sent = []
+            await send_copy(spool, message, sent)
+            await send_copy(spool, edited, sent)
+            await send_copy(spool, edited, sent)
+        # The files are deleted by the callbacks of their downloads
+        await asyncio.sleep(0)
+        assert sent[0].endswith("video.mp4") and sent[1].endswith("video.mp4")
+        assert sent[0] != sent[1] and sent[2] == "file_id1"
+        assert spool.shared == {}
+        assert spool.used == 0
+    asyncio.run(main())
+
+
+def test_uploaded_files_free_the_spool(tmp_path):
+    async def main():
+        spool = MediaSpool(tmp_path, memory_limit=0, max_bytes=100,
+                           wait_timeout=5)
+        scheduler = Scheduler(workers=4, bulk_workers=4)
+        x, y = Video(1, 80), Video(2, 80)
+        sent = []
+        jobs = []
+        # Y to target 2 is queued behind X, that waits for the space of Y
+        with spool.sharing(x, jobs), spool.sharing(y, jobs):
+            for message, target in ((y, 1), (x, 2), (y, 2)):
+                jobs.append(await scheduler.submit(
+                    target, "bulk", {message.id}, send_copy, spool, message,
+                    sent))
+        await asyncio.wait_for(asyncio.gather(*jobs), 2)
+        await asyncio.sleep(0.05)
+        assert sent[2] == "file_id2"
+        assert spool.shared == {}
+        assert spool.used == 0
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+import random
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "app"))
+
+from rewrite import Rewriter  # noqa: E402
+
+
+def sequential_replace(words: dict, mode: str, text: str) -> str:
+    """The replace_words of before the Rewriter, one re.sub per word."""
+    for word in words:
+        if mode == "word_boundary_match":
+            if word[0] in ["@", "#", "$"]:
+                pattern = r"[%s]\b%s\b" % (word[0], word[1:])
+            elif word[-1] in ["@", "#", "$"]:
+                pattern = r"\b%s[%s]" % (word[:-1], word[-1])
+            else:
+                pattern = r"\b%s\b" % word
+            text = re.sub(pattern, words[word], text, flags=re.I)
+        else:
+            text = re.sub(word, words[word], text, flags=re.I)
+    return text
+
+
+def rewrite(words: dict, mode: str, text: str) -> str:
+    forwarder = {"replace_words": words, "replace_words_mode": mode,
+                 "patterns": []}
+    return Rewriter(forwarder).replace(text)
+
+
+@pytest.mark.parametrize("words, mode, text", [
+    # A replacement that starts a later word with the text after it
+    ({"a": "new", "new york": "NYC"}, "word_boundary_match", "a york"),
+    # A replacement that ends a later word with the text after it
+    ({"cd": "a", "ab": ""}, "any", "cdb"),
+    # A removed word joins the text before and after it
+    ({"x": "", "ab": "Z"}, "any", "axb"),
+    # A replaced symbol removes the boundary of the word before it
+    ({"#a": "a ", "#b": "c "}, "word_boundary_match", "#c#b#a#"),
+    ({"#btc": "bitcoin", "eth": "ether"}, "word_boundary_match", "eth#btc"),
+])
+def test_same_as_sequential(words, mode, text):
+    assert rewrite(words, mode, text) == sequential_replace(words, mode, text)
+
+
+@pytest.mark.parametrize("mode", ["any", "word_boundary_match"])
+def test_random_same_as_sequential(mode):
+    rng = random.Random(0)
+    for _ in range(20000):
+        words = {}
+        for _ in range(rng.randint(1, 4)):
+            word = "".join(rng.choice("abA ")
+                           for _ in range(rng.randint(1, 4))).strip() or "a"
+            if mode == "word_boundary_match" and rng.random() < 0.3:
+                word = rng.choice(["#" + word, word + "@"])
+            words[word] = "".join(rng.choice("ab -#@")
+                                  for _ in range(rng.randint(0, 3)))
+        text = "".join(rng.choice("ab -#@") for _ in range(rng.randint(0, 12)))
+        assert rewrite(words, mode, text) ==\
+            sequential_replace(words, mode, text), (words, text)